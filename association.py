@@ -0,0 +1,34 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+class index:
+    # KD-tree over one channel's centroids, built once and queried by radius.
+
+    def __init__(self, centroids):
+        self.points = np.asarray(centroids, dtype=float).reshape(-1, 3)
+        self.tree = cKDTree(self.points)
+
+    def __len__(self):
+        return len(self.points)
+
+    def neighbors(self, other, radius):
+        # CSR assignment: other[indices[indptr[i]:indptr[i + 1]]] lie closer than radius to self[i].
+
+        pairs = self.tree.sparse_distance_matrix(other.tree,           # only pairs within radius are visited
+                                                 radius,
+                                                 output_type='ndarray')
+        pairs = pairs[pairs['v'] < radius]                             # strict, as with distance_matrix < radius
+
+        order = np.lexsort((pairs['j'], pairs['i']))                   # row-major, neighbours ascending
+        rows = pairs['i'][order]
+        indices = pairs['j'][order].astype(np.intp)
+
+        indptr = np.zeros(len(self) + 1, dtype=np.intp)
+        np.cumsum(np.bincount(rows, minlength=len(self)), out=indptr[1:])
+
+        return indptr, indices
+
+def rows(indptr, indices):
+    # expand a CSR assignment into {row: [indices]}.
+
+    return {i: indices[indptr[i]:indptr[i + 1]].tolist() for i in range(len(indptr) - 1)}
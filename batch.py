@@ -0,0 +1,137 @@
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import pipeline
+from caching import cache as segmentation_cache
+
+extensions = ('.tif', '.tiff')
+
+def find(pattern):
+    # image files in a directory, or matching a glob pattern.
+
+    if os.path.isdir(pattern):
+        files = [os.path.join(pattern, i) for i in os.listdir(pattern)]
+    else:
+        files = glob.glob(pattern)
+
+    return sorted(i for i in files if i.lower().endswith(extensions))
+
+def outdated(file, records = None):
+    # True if the CSV for file, or one of its requested record tables (<file>_cells.*,
+    # <file>_puncta.* in each of the formats records), is missing or older than the image.
+
+    output = pipeline.output_for(file)
+    outputs = [output] + [f'{output[:-4]}_{name}.{format}' for format in records or () for name in ('cells', 'puncta')]
+    return any(not os.path.exists(i) or os.path.getmtime(i) < os.path.getmtime(file) for i in outputs)
+
+def worker_count(files, workers = None, memory_factor = 10, threads = 1):
+    # cap concurrency so that workers * threads * (largest file * memory_factor) fits in free memory.
+
+    workers = workers or os.cpu_count() or 1
+    workers = max(1, min(workers, len(files)))
+
+    memory = pipeline.available_memory()
+    if memory and files:
+        per_file = max(os.path.getsize(i) for i in files) * memory_factor * threads
+        workers = max(1, min(workers, int(memory // per_file)))
+
+    return workers
+
+def run(pattern,
+        workers = None,                     # process pool size (default: CPU count)
+        memory_factor = 10,                 # estimated peak memory per worker, as a multiple of file size
+        force = False,                      # reprocess files whose CSV is up to date
+        summary = None,                     # combined per-file table (default: <directory>/summary.csv)
+        block = None,                       # block size (z, y, x) for out-of-core segmentation
+        profile = False,                    # write <file>_profile.json/.csv run reports
+        cache = None,                       # directory of the segmentation cache (None: no cache)
+        precision = None,                   # e.g. 'float32': compact intermediates (default float64)
+        threads = 1,                        # channels segmented concurrently within each worker
+        filter_threads = 1,                 # threads per filter within each channel
+        approximate = None,                 # sigma from which Gaussian filters are approximated by box filters
+        downsample = None,                  # cells on a coarser grid: 'auto' or (z, y, x) factors
+        records = None,                     # formats of per-cell/per-punctum tables, e.g. ('csv', 'parquet')
+        membership = 'distance',            # puncta in cells by 'distance', or 'centroid'/'overlap' in the cell labels
+        colocalization = 'distance'):       # puncta1/puncta2 partners by centroid 'distance' or voxel 'overlap'
+
+    cache = segmentation_cache(cache) if cache else None
+
+    files = find(pattern)
+    todo = [i for i in files if force or outdated(i, records)]
+    workers = worker_count(todo, workers, memory_factor, threads)
+
+    print(f'{len(files)} files, {len(files) - len(todo)} up to date, {workers} workers')
+
+    start = time.time()
+    errors = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = {pool.submit(pipeline.process, i, block = block, profile = profile, cache = cache,
+                           precision = precision, threads = threads, filter_threads = filter_threads,
+                           approximate = approximate, downsample = downsample,
+                           records = records, membership = membership,
+                           colocalization = colocalization): i for i in todo}
+        for job in as_completed(jobs):
+            file = jobs[job]
+            try:
+                job.result()
+                print(f'{file}...done ' + str(time.time() - start))
+            except Exception as error:
+                errors[file] = repr(error)
+                print(f'{file}...failed: {error!r}')
+
+    rows = []
+    for file in files:
+        if file in errors:
+            rows.append({'file': file, 'error': errors[file]})
+        else:
+            rows.append(pipeline.summarize(file, pipeline.output_for(file)))
+
+    if summary is None:
+        directory = pattern if os.path.isdir(pattern) else os.path.dirname(pattern)
+        summary = os.path.join(directory, "summary.csv")
+    pd.DataFrame(rows).to_csv(summary, index=False)
+
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='segment, quantify and write every image in a directory or glob.')
+    parser.add_argument('pattern', help='directory or glob pattern of .tif files')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--memory-factor', type=float, default=10, help='peak memory per file, as a multiple of file size')
+    parser.add_argument('-f', '--force', action='store_true', help='reprocess files with up-to-date outputs')
+    parser.add_argument('-o', '--summary', default=None, help='combined summary CSV')
+    parser.add_argument('--block', type=int, nargs=3, default=None, metavar=('Z', 'Y', 'X'),
+                        help='segment in blocks of this size (for stacks larger than memory)')
+    parser.add_argument('--profile', action='store_true', help='write per-step timing and peak memory next to each CSV')
+    parser.add_argument('--cache', default=None, metavar='DIRECTORY',
+                        help='reuse segmentations stored here by earlier runs with the same parameters')
+    parser.add_argument('--precision', default=None, choices=['float32', 'float64'],
+                        help='float type of filter outputs; float32 also stores labels as uint16/uint32')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='channels segmented concurrently per file (with fewer files than cores)')
+    parser.add_argument('--filter-threads', type=int, default=1,
+                        help='threads per filter, splitting each volume into slabs (for a few large stacks)')
+    parser.add_argument('--approximate', type=float, default=None, metavar='SIGMA',
+                        help='approximate Gaussian filters of at least this sigma by repeated box filters')
+    parser.add_argument('--downsample', nargs='+', default=None, metavar='FACTOR',
+                        help="segment cells on a grid coarser by 'auto' (roughly isotropic voxels) or Z Y X factors")
+    parser.add_argument('--records', nargs='+', default=None, choices=['csv', 'parquet'],
+                        help='also write per-cell and per-punctum tables (<file>_cells.*, <file>_puncta.*)')
+    parser.add_argument('--membership', default='distance', choices=['distance', 'centroid', 'overlap'],
+                        help='assign puncta to cells by centroid distance, or by the cell label at their centroid/voxels')
+    parser.add_argument('--colocalization', default='distance', choices=['distance', 'overlap'],
+                        help='pair puncta1 with puncta2 by centroid distance or by shared voxels (adds Manders coefficients)')
+    args = parser.parse_args()
+
+    downsample = args.downsample
+    if downsample is not None and downsample != ['auto']:
+        downsample = tuple(int(i) for i in downsample)
+    elif downsample is not None:
+        downsample = 'auto'
+
+    run(args.pattern, args.workers, args.memory_factor, args.force, args.summary, args.block, args.profile, args.cache,
+        args.precision, args.threads, args.filter_threads, args.approximate, downsample,
+        args.records, args.membership, args.colocalization)
@@ -0,0 +1,245 @@
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import tifffile
+from scipy import ndimage as ndi
+from loading import stack
+from segmentation import segment
+from quantification import quantify
+from pipeline import segment_all
+import tiling
+
+# segmentation/quantification parameters suited to the synthetic volumes below
+# (isotropic 1 µm voxels, cells ~32 voxels across, puncta sigma 1 voxel).
+spacing = [1, 1, 1]
+channels = {0: dict(sigma = 2, width = 4),
+            1: dict(sigma = 0.5, width = 3),
+            2: dict(sigma = 0.5, width = 3)}
+parameters = dict(threshold = 2,
+                  dist = 14,
+                  puncta1_min = 5,
+                  puncta1_max = 500,
+                  cell_min = 2000,
+                  cell_max = 50000)
+
+def synthetic(shape, density, seed = 0, coloc = 0.5, radius = (10, 16, 16), punctum = 2, sigma = 0.5,
+              separation = 8):
+    # reproducible 4D stack (z, y, x, channel) of ellipsoidal cells (channel 0) holding
+    # puncta (channel 1): solid balls of radius punctum, blurred by a Gaussian of sigma once
+    # placed, so each has a known voxel count. a fraction coloc of them also appears in channel 2.
+    # density: puncta1 per cell. returns (image, truth).
+
+    rng = np.random.default_rng(seed)
+    image = np.zeros(tuple(shape) + (3,), dtype=np.float32)
+    radius = np.array(radius)
+
+    # cells on a grid, spaced so that they don't touch, with room for puncta near their edge.
+    half = int(np.ceil(punctum + 4 * sigma))
+    step = 2 * radius + 8
+    margin = np.maximum(radius, np.ceil(0.6 * radius).astype(int) + half) + 1
+    grid = [np.arange(m, n - m, s) for n, m, s in zip(shape, margin, step)]
+    cells = np.array(np.meshgrid(*grid, indexing='ij')).reshape(3, -1).T
+    zz, yy, xx = np.ogrid[-radius[0]:radius[0] + 1, -radius[1]:radius[1] + 1, -radius[2]:radius[2] + 1]
+    ellipsoid = (zz / radius[0])**2 + (yy / radius[1])**2 + (xx / radius[2])**2 <= 1
+    for c in cells:
+        box = tuple(slice(i - r, i + r + 1) for i, r in zip(c, radius))
+        image[box + (0,)] += ellipsoid * 1000
+
+    # puncta well inside each cell, at least separation voxels apart.
+    zz, yy, xx = np.mgrid[-half:half + 1, -half:half + 1, -half:half + 1]
+    ball = (zz**2 + yy**2 + xx**2 <= punctum**2) * 3000.0
+    puncta, partner = [], []
+    for c in cells:
+        placed = []
+        for _ in range(density * 20):
+            if len(placed) == density:
+                break
+            offset = rng.uniform(-0.6, 0.6, 3) * radius
+            if (offset[0] / radius[0])**2 + (offset[1] / radius[1])**2 + (offset[2] / radius[2])**2 > 0.36:
+                continue
+            p = np.round(c + offset).astype(int)
+            if all(np.linalg.norm(p - q) >= separation for q in placed):
+                placed.append(p)
+        for p in placed:
+            box = tuple(slice(i - half, i + half + 1) for i in p)
+            image[box + (1,)] += ball
+            partner.append(rng.random() < coloc)
+            if partner[-1]:
+                image[box + (2,)] += ball
+        puncta += placed
+
+    for channel in (1, 2):
+        image[..., channel] = ndi.gaussian_filter(image[..., channel], sigma)
+
+    image += rng.normal(100, 10, image.shape).astype(np.float32)
+    image = np.clip(image, 0, 65535).astype(np.uint16)
+
+    truth = {'cells': len(cells),
+             'puncta1': len(puncta),
+             'puncta1_per_cell': len(puncta) / max(len(cells), 1),
+             'puncta1_volume': float(np.count_nonzero(ball)),   # voxels of one ball (spacing 1 µm: µm^3)
+             'coloc': float(np.mean(partner)) if partner else np.nan}
+
+    return image, truth
+
+def dice(a, b):
+    # overlap of two foreground masks: 1 when identical, 0 when disjoint.
+
+    a, b = np.asarray(a) > 0, np.asarray(b) > 0
+    total = np.count_nonzero(a) + np.count_nonzero(b)
+    return 2 * np.count_nonzero(a & b) / total if total else 1.0
+
+def same(a, b):
+    # two segment() outputs, volume for volume and table for table.
+
+    return all(np.array_equal(np.asarray(i), np.asarray(j)) for i, j in zip(a, b))
+
+def check(shapes, density = 4, seed = 0):
+    # assert that the alternative segmentation paths reproduce the in-memory, serial, float64 one
+    # on synthetic stacks: out-of-core blocks (including blocks thinner than the halos), filter
+    # threads and concurrent channels exactly; float32 with the same object counts and masks
+    # agreeing on >= 98% of voxels (Dice; puncta are mostly boundary); box-filter Gaussians
+    # within 2% of the exact filter on average. returns the names of the checks that passed.
+
+    passed = []
+    for shape in shapes:
+        name = 'x'.join(map(str, shape))
+        data, _ = synthetic(shape, density, seed)
+        with tempfile.TemporaryDirectory() as directory:
+            file = os.path.join(directory, 'synthetic.tif')
+            tifffile.imwrite(file, data)
+            image = stack(file)
+
+            reference = {channel: segment(image, channel = channel, spacing = spacing, **kwargs)
+                         for channel, kwargs in channels.items()}
+            for channel, kwargs in channels.items():
+                for block in [(7, 50, 33), (shape[0], shape[1], 40)]:
+                    tiled = segment(image, channel = channel, spacing = spacing, block = block, **kwargs)
+                    assert same(tiled, reference[channel]), f'{name} channel {channel}: block {block} != in-memory'
+                    passed.append(f'{name} channel {channel}: block {block} == in-memory')
+
+                threaded = segment(image, channel = channel, spacing = spacing, threads = 3, **kwargs)
+                assert same(threaded, reference[channel]), f'{name} channel {channel}: 3 filter threads != serial'
+                passed.append(f'{name} channel {channel}: 3 filter threads == serial')
+
+                compact = segment(image, channel = channel, spacing = spacing, precision = 'float32', **kwargs)
+                overlap = dice(compact[4], reference[channel][4])
+                assert len(compact[1]) == len(reference[channel][1]) and overlap >= 0.98, \
+                    f'{name} channel {channel}: float32 {len(compact[1])} objects, Dice {overlap:.4f}'
+                passed.append(f'{name} channel {channel}: float32 same objects, Dice {overlap:.4f}')
+
+            concurrent = segment_all(image, spacing = spacing, channels = channels, threads = 3, filter_threads = 1)
+            assert all(same(concurrent[i], reference[i]) for i in channels), f'{name}: concurrent channels != serial'
+            passed.append(f'{name}: concurrent channels == serial')
+
+            cells = np.asarray(image.channel(0), dtype=float)
+            exact = ndi.gaussian_filter(cells, sigma = 8)
+            approximate = tiling.box_gaussian(cells, 8, np.empty_like(cells))
+            error = np.mean(np.abs(approximate - exact)) / np.mean(exact)
+            assert error <= 0.02, f'{name}: box-filter Gaussian off by {error:.2%} on average'
+            passed.append(f'{name}: box-filter Gaussian within {error:.2%} on average')
+            del image, reference, concurrent
+
+    return passed
+
+def run(shapes, densities, repeats = 1, seed = 0, downsample = None):
+    # time segment() per channel and quantify for every shape x density.
+    # returns one row per run: timings, throughput, measured values and ground truth.
+    # downsample: also segment cells on a coarser grid ('auto' or (z, y, x) factors) and
+    # report its time, cell count and Dice overlap with the full-resolution cells.
+
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:       # removed with its stacks on return
+        for shape in shapes:
+            for density in densities:
+                data, truth = synthetic(shape, density, seed)
+                file = os.path.join(directory, 'synthetic.tif')
+                tifffile.imwrite(file, data)
+                voxels = int(np.prod(shape))
+
+                for repeat in range(repeats):
+                    image = stack(file)
+                    row = {'shape': 'x'.join(map(str, shape)), 'density': density, 'repeat': repeat, 'voxels': voxels}
+
+                    segmented = {}
+                    for channel, kwargs in channels.items():
+                        start = time.perf_counter()
+                        segmented[channel] = segment(image, channel = channel, spacing = spacing, **kwargs)
+                        row[f'segment_{channel}'] = time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    quantified = quantify(centroids_cells = segmented[0][1],
+                                          area_cells = segmented[0][2],
+                                          centroids_puncta1 = segmented[1][1],
+                                          area_puncta1 = segmented[1][2],
+                                          centroids_puncta2 = segmented[2][1],
+                                          area_puncta2 = segmented[2][2],
+                                          spacing = spacing,
+                                          **parameters)
+                    _, count = quantified.count()
+                    _, volume = quantified.volume()
+                    coloc = quantified.coloc()
+                    row['quantify'] = time.perf_counter() - start
+
+                    if downsample is not None:
+                        start = time.perf_counter()
+                        coarse = segment(image, channel = 0, spacing = spacing, downsample = downsample, **channels[0])
+                        row['segment_0_coarse'] = time.perf_counter() - start
+                        row['cells_coarse'] = len(coarse[1])
+                        row['cells_dice'] = dice(coarse[4], segmented[0][4])
+
+                    segment_time = sum(row[f'segment_{i}'] for i in channels)
+                    row['voxels/s'] = voxels / segment_time
+                    row['puncta/s'] = len(segmented[1][1]) / row['quantify'] if row['quantify'] else np.nan
+
+                    row.update({'cells': len(count),
+                                'puncta1': len(segmented[1][1]),
+                                'puncta1_per_cell': np.mean(count) if len(count) else np.nan,
+                                'puncta1_volume': np.mean(volume) if len(volume) else np.nan,
+                                'coloc': np.mean(coloc) if len(coloc) else np.nan})
+                    row.update({'truth_' + key: value for key, value in truth.items()})
+                    rows.append(row)
+
+                    print(f"{row['shape']} density {density}: {segment_time:.2f} s segment, "
+                          f"{row['quantify']:.3f} s quantify, {row['voxels/s']:.3g} voxels/s, "
+                          f"{row['cells']}/{truth['cells']} cells, {row['puncta1']}/{truth['puncta1']} puncta1")
+                    if downsample is not None:
+                        print(f"  coarse cells: {row['segment_0_coarse']:.2f} s (full {row['segment_0']:.2f} s), "
+                              f"{row['cells_coarse']} cells, Dice {row['cells_dice']:.3f}")
+
+    return pd.DataFrame(rows)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='time segment() and quantify on synthetic cell/puncta volumes.')
+    parser.add_argument('--shapes', nargs='+', default=None,
+                        help='volume sizes as ZxYxX (default 32x128x128 48x256x256 64x512x512; '
+                             'with --check, 32x128x128 48x256x256)')
+    parser.add_argument('--densities', nargs='+', type=int, default=[4, 12], help='puncta1 per cell')
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--downsample', nargs='+', default=None, metavar='FACTOR',
+                        help="also segment cells downsampled by 'auto' or Z Y X factors, and report the accuracy")
+    parser.add_argument('--check', action='store_true',
+                        help='instead of timing, assert that tiled, threaded and float32 segmentations match the default')
+    parser.add_argument('-o', '--output', default=None, help='write results to this CSV')
+    args = parser.parse_args()
+
+    if args.shapes is None:
+        args.shapes = ['32x128x128', '48x256x256'] if args.check else ['32x128x128', '48x256x256', '64x512x512']
+    shapes = [tuple(int(i) for i in shape.split('x')) for shape in args.shapes]
+    if args.check:
+        passed = check(shapes, args.densities[0], args.seed)
+        print('\n'.join(passed))
+        print(f'{len(passed)} checks passed')
+        raise SystemExit
+    downsample = args.downsample
+    if downsample is not None and downsample != ['auto']:
+        downsample = tuple(int(i) for i in downsample)
+    elif downsample is not None:
+        downsample = 'auto'
+    results = run(shapes, args.densities, args.repeats, args.seed, downsample)
+    if args.output:
+        results.to_csv(args.output, index=False)
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import warnings
+import numpy as np
+import pandas as pd
+from segmentation import shrink
+
+version = 1                                             # bump when segment() results change
+
+volumes = ['transformed', 'segmented', 'speckles', 'labels']
+
+class cache:
+    # persistent store of segment() results, keyed by the input file's content and the
+    # segmentation parameters. only the tables and the given volumes are kept (by default
+    # speckles, all quantify reads); the others load as None. label volumes are stored in
+    # the smallest integer type, in one compressed .npz or, with compress=False, as .npy
+    # (memory-mapped on load). least recently used entries are evicted once the store grows
+    # past max_bytes.
+
+    def __init__(self, directory = None, max_bytes = 50 * 2**30, compress = True, volumes = ('speckles',)):
+        self.directory = directory or os.environ.get('PUNCTA_CACHE',
+                                                     os.path.join(os.path.expanduser('~'), '.cache', 'puncta'))
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.volumes = list(volumes)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __repr__(self):
+        entries = self.entries()
+        return (f'''cache: {self.directory}
+entries: {len(entries)}
+size: {sum(i[2] for i in entries) / 2**30:.2f} GiB of {self.max_bytes / 2**30:.2f} GiB''')
+
+    def digest(self, file):
+        # sha256 of the file's content; remembered per (path, size, mtime) so it is read once.
+
+        stat = os.stat(file)
+        name = f'{os.path.abspath(file)}:{stat.st_size}:{stat.st_mtime_ns}'
+        index = os.path.join(self.directory, 'digests.json')
+        try:
+            with open(index) as handle:
+                known = json.load(handle)
+        except (OSError, ValueError):
+            known = {}
+
+        if name not in known:
+            sha = hashlib.sha256()
+            with open(file, 'rb') as handle:
+                for chunk in iter(lambda: handle.read(2**24), b''):
+                    sha.update(chunk)
+            known[name] = sha.hexdigest()
+            temporary = f'{index}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temporary, 'w') as handle:
+                json.dump(known, handle)
+            os.replace(temporary, index)
+
+        return known[name]
+
+    def key(self, file, **parameters):
+        # entry name for file + parameters.
+
+        parameters = {name: np.asarray(value).tolist() for name, value in parameters.items()}
+        text = json.dumps({'file': self.digest(file), 'version': version, **parameters}, sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def load(self, key):
+        # segment() output for key, or None. marks the entry as recently used. an entry evicted
+        # meanwhile (by another thread or process sharing the directory) is a miss.
+
+        path = os.path.join(self.directory, key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            return self.read(path)
+        except FileNotFoundError:
+            return None
+
+    def read(self, path):
+        os.utime(path)
+
+        with np.load(os.path.join(path, 'tables.npz')) as tables:
+            centroids = pd.DataFrame(tables['centroids'], columns=list(tables['centroid_columns']))
+            area = pd.DataFrame(tables['area'], columns=list(tables['area_columns']))
+            stored = list(tables['volumes']) if 'volumes' in tables.files else None
+
+        arrays = dict.fromkeys(volumes)                 # volumes not stored stay None
+        if os.path.exists(os.path.join(path, 'volumes.npz')):
+            with np.load(os.path.join(path, 'volumes.npz')) as archive:
+                arrays.update({name: archive[name] for name in archive.files})
+        else:
+            stored = stored if stored is not None else [name for name in volumes
+                                                         if os.path.exists(os.path.join(path, name + '.npy'))]
+            arrays.update({name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in stored})
+        if stored is not None and any(arrays[name] is None for name in stored):
+            raise FileNotFoundError(path)               # partly removed
+
+        return arrays['transformed'], centroids, area, arrays['segmented'], arrays['speckles'], arrays['labels']
+
+    def save(self, key, result):
+        # store a segment() output under key (written to a temporary directory, then renamed).
+
+        transformed, centroids, area, segmented, speckles, labels = result
+        arrays = dict(transformed=transformed, segmented=segmented, speckles=speckles, labels=labels)
+        arrays = {name: arrays[name] if name == 'transformed' else shrink(arrays[name]) for name in self.volumes}
+
+        temporary = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        if self.compress:
+            np.savez_compressed(os.path.join(temporary, 'volumes.npz'), **arrays)
+        else:
+            for name, array in arrays.items():
+                np.save(os.path.join(temporary, name + '.npy'), array)
+        np.savez(os.path.join(temporary, 'tables.npz'),
+                 centroids=np.asarray(centroids), centroid_columns=np.array(centroids.columns, dtype=str),
+                 area=np.asarray(area), area_columns=np.array(area.columns, dtype=str),
+                 volumes=np.array(list(arrays), dtype=str))
+
+        path = os.path.join(self.directory, key)
+        size = sum(os.path.getsize(os.path.join(temporary, i)) for i in os.listdir(temporary))
+        if size > self.max_bytes:
+            warnings.warn(f'cache entry of {size / 2**20:.1f} MiB is larger than max_bytes '
+                          f'({self.max_bytes / 2**20:.1f} MiB); it is kept, and older entries are evicted')
+        try:
+            os.replace(temporary, path)
+        except OSError:                                 # written concurrently by another process
+            shutil.rmtree(temporary, ignore_errors=True)
+        self.evict(keep = path)
+
+    def entries(self):
+        # (path, last use, bytes) of every entry.
+
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, i)) for i in os.listdir(path))
+                entries.append((path, os.path.getmtime(path), size))
+            except FileNotFoundError:                   # evicted meanwhile
+                continue
+        return entries
+
+    def evict(self, keep = None):
+        # remove least recently used entries until the store fits in max_bytes (never keep,
+        # the entry just saved).
+
+        entries = sorted(self.entries(), key=lambda i: i[1])
+        total = sum(i[2] for i in entries)
+        entries = [i for i in entries if i[0] != keep]
+        while entries and total > self.max_bytes:
+            path, _, size = entries.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
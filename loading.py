@@ -0,0 +1,49 @@
+import numpy as np
+import skimage
+import tifffile
+
+class stack:
+    # decode (or memory-map) a 4D image once and hand out per-channel views.
+
+    def __init__(self, file, mmap = True):
+        self.file = file
+        self.data = None
+
+        if mmap:
+            try:
+                self.data = tifffile.memmap(file, mode='r')     # zero-copy for uncompressed, contiguous TIFFs
+            except (ValueError, TypeError, OSError):
+                self.data = None                                # compressed/tiled files can't be mapped
+
+        if self.data is None:
+            self.data = skimage.io.imread(file)                 # fall back to a single full decode
+
+    def __repr__(self):
+        mapped = isinstance(self.data, np.memmap)
+        return (f'''file: {self.file}
+shape: {self.data.shape}
+dtype: {self.data.dtype}
+memory-mapped: {mapped}''')
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def channels(self):
+        return self.data.shape[-1]
+
+    def channel(self, idx):
+        # zero-copy view of one channel (z, y, x).
+
+        return self.data[..., idx]
+
+def open_stack(source):
+    # accept a filename or an already opened stack.
+
+    if isinstance(source, stack):
+        return source
+    return stack(source)
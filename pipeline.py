@@ -0,0 +1,149 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from loading import stack
+from segmentation import segment
+from quantification import quantify
+from writing import write_to_csv, write_records
+from profiling import profiler
+
+spacing = [0.5, 0.0625, 0.0625]             # microscope spacing (z, x, y)
+
+channels = {                                # segmentation parameters per channel
+    0: dict(sigma = 20, width = 20),        # cells
+    1: dict(sigma = 1, width = 5),          # puncta1
+    2: dict(sigma = 2, width = 3),          # puncta2
+}
+
+parameters = dict(threshold = 15,           # quantification parameters
+                  dist = 180,
+                  puncta1_min = 90,
+                  puncta1_max = 5000,
+                  cell_min = 25000,
+                  cell_max = 60000)
+
+def available_memory():
+    # bytes of free physical memory, or None where sysconf can't tell.
+
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def thread_count(image, channels = channels, threads = None, block = None, precision = None, volumes = 12):
+    # channels segmented at once: at most one thread per channel and CPU, and no more than
+    # fit in free memory at ~volumes intermediate arrays per channel (of the block, when tiled).
+
+    threads = threads or os.cpu_count() or 1
+    threads = max(1, min(threads, len(channels)))
+
+    memory = available_memory()
+    if memory:
+        voxels = np.prod(block) if block is not None else np.prod(image.shape[:3])
+        per_channel = voxels * np.dtype(precision or float).itemsize * volumes
+        threads = max(1, min(threads, int(memory // per_channel)))
+
+    return threads
+
+def segment_all(image, spacing = spacing, channels = channels, block = None, profile = None, cache = None,
+                precision = None, threads = None, filter_threads = None, approximate = None, downsample = None):
+    # segment every channel of one stack. returns {channel: segment() output}.
+    # block: block size (z, y, x) for out-of-core segmentation of stacks larger than memory.
+    # cache: caching.cache; channels segmented before with the same parameters are loaded from disk.
+    # precision: e.g. 'float32' to keep filter outputs in float32 and labels in uint16/uint32.
+    # threads: channels segmented concurrently (default: see thread_count, or 1 when profiling).
+    # the channels share the decoded image, and the scipy/skimage filters release the GIL, so wall
+    # time approaches that of the slowest channel. results don't depend on the thread count.
+    # filter_threads: threads splitting each filter into slabs (default: the CPUs left per channel).
+    # approximate: sigma from which Gaussian filters are approximated by box filters.
+    # downsample: segment cells on a coarser grid ('auto': roughly isotropic voxels from spacing).
+
+    profiling = profile is not None and profile.enabled
+    if profiling and threads is None:
+        threads = 1                             # peak memory is process-wide: profile channels one at a time
+    threads = thread_count(image, channels, threads, block, precision)
+    if profiling and threads > 1:
+        profile.tags['concurrent'] = True       # peaks of these records include the other channels' stages
+    filter_threads = filter_threads or max(1, (os.cpu_count() or 1) // threads)
+
+    def run(channel):
+        return segment(image, channel = channel, spacing = spacing, block = block, profile = profile,
+                       cache = cache, precision = precision, threads = filter_threads, approximate = approximate,
+                       downsample = downsample, **channels[channel])
+
+    if threads == 1:
+        return {channel: run(channel) for channel in channels}
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return dict(zip(channels, pool.map(run, channels)))
+
+def quantify_all(segmented, spacing = spacing, parameters = parameters, membership = 'distance',
+                 colocalization = 'distance'):
+    # build quantify from the cell, puncta1 and puncta2 segmentations.
+    # membership: 'distance' (centroids within dist), or 'centroid'/'overlap' in the cell labels.
+    # colocalization: 'distance' (centroids within threshold) or 'overlap' (shared voxels).
+
+    _, centroids_cell, area_cell, _, cell_labels, _ = segmented[0]
+    _, centroids_puncta1, area_puncta1, _, puncta1_labels, _ = segmented[1]
+    _, centroids_puncta2, area_puncta2, _, puncta2_labels, _ = segmented[2]
+
+    return quantify(centroids_puncta1 = centroids_puncta1,
+                    area_puncta1 = area_puncta1,
+                    centroids_cells = centroids_cell,
+                    area_cells = area_cell,
+                    centroids_puncta2 = centroids_puncta2,
+                    area_puncta2 = area_puncta2,
+                    spacing = spacing,
+                    membership = membership,
+                    cell_labels = cell_labels,
+                    puncta1_labels = puncta1_labels,
+                    colocalization = colocalization,
+                    puncta2_labels = puncta2_labels,
+                    **parameters)
+
+def output_for(file):
+    # CSV written for file (same name, .csv extension).
+
+    return os.path.splitext(file)[0] + ".csv"
+
+def process(file, spacing = spacing, channels = channels, parameters = parameters, block = None, profile = False,
+            cache = None, precision = None, threads = None, filter_threads = None, approximate = None,
+            downsample = None, records = None, membership = 'distance', colocalization = 'distance'):
+    # segment -> quantify -> write for one file. returns the CSV path.
+    # records: formats ('csv', 'parquet') of per-cell and per-punctum tables, streamed to
+    # <file>_cells.* and <file>_puncta.*.
+    # profile: also write per-step wall/CPU time and peak memory to <file>_profile.json/.csv.
+
+    output = output_for(file)
+    timer = profiler(enabled = profile, file = os.path.basename(file))
+
+    with timer.stage('total'):
+        with timer.stage('load'):
+            image = stack(file)
+        with timer.stage('segment'):
+            segmented = segment_all(image, spacing, channels, block, timer, cache, precision, threads,
+                                     filter_threads, approximate, downsample)
+        with timer.stage('quantify'):
+            quantified = quantify_all(segmented, spacing, parameters, membership, colocalization)
+        with timer.stage('write'):
+            write_to_csv(output[:-4], quantified)
+            if records:
+                write_records(output[:-4], quantified, records)
+
+    if profile:
+        timer.write(output[:-4] + "_profile")
+
+    return output
+
+def summarize(file, output):
+    # one summary row from a per-file CSV (cells, and means over cells of count/volume/coloc;
+    # volume and coloc over the cells holding puncta1).
+
+    values = pd.read_csv(output, index_col=0)
+
+    return {'file': file,
+            'cells': len(values),
+            'average_count': values['average_count'].mean(),
+            'average_volume': values['average_volume'].mean(),
+            'average_coloc': values['average_coloc'].mean()}
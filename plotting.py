@@ -1,40 +1,46 @@
-import napari
 import numpy as np
 
-def plot(img, cells, puncta1, puncta2):
+def pyramid(volume, budget = 2**28):
+    # multiscale levels of a (z, y, x) volume as strided views: y and x halve per level
+    # (z is usually sampled coarsely already) until the coarsest level fits in budget bytes.
+    # views of memory-mapped arrays read only what napari displays.
+
+    volume = np.asarray(volume)                 # no copy (memory maps stay mapped)
+    levels = [volume]
+    step = 1
+    while levels[-1].nbytes > budget and min(levels[-1].shape[1:]) > 1:
+        step *= 2
+        levels.append(volume[:, ::step, ::step])
+    return levels
+
+def labels(volume):
+    # label layer data without a copy (napari needs integers; bool masks are viewed as uint8).
+
+    volume = np.asarray(volume)
+    return volume.view(np.uint8) if volume.dtype == bool else volume
+
+def plot(img, cells, puncta1, puncta2, budget = 2**28):
     # plot 3D images and segmentation in napari.
+    # every layer is a lazy pyramid whose coarsest level fits in budget bytes.
 
-    viewer = napari.Viewer()
+    import napari                               # Qt and napari load only when a viewer opens
 
-    labels_as_image_layer = viewer.add_image(
-        img[:, :, :, 0],
-        name = 'Blue'
-    )
-    labels_as_image_layer = viewer.add_image(
-        img[:, :, :, 1],
-        name = 'Green'
-    )
-    labels_as_image_layer = viewer.add_image(
-        img[:, :, :, 2],
-        name = 'Red'
-    )
-
-    cells = np.array(cells, dtype=int)
-    labels_as_image_layer = viewer.add_image(
-        cells,
-        name = 'Cells'
-        )
+    viewer = napari.Viewer()
 
-    ld = np.array(puncta1, dtype=int)
-    labels_as_image_layer = viewer.add_image(
-        ld,
-        name = 'puncta1'
+    for channel, name in enumerate(['Blue', 'Green', 'Red']):
+        levels = pyramid(img[:, :, :, channel], budget)
+        viewer.add_image(
+            levels if len(levels) > 1 else levels[0],
+            multiscale = len(levels) > 1,
+            name = name
         )
 
-    dye = np.array(puncta2, dtype=int)
-    labels_as_image_layer = viewer.add_image(
-        dye,
-        name = 'puncta2'
+    for volume, name in [(cells, 'Cells'), (puncta1, 'puncta1'), (puncta2, 'puncta2')]:
+        levels = pyramid(labels(volume), budget)
+        viewer.add_labels(
+            levels if len(levels) > 1 else levels[0],
+            multiscale = len(levels) > 1,
+            name = name
         )
 
-    napari.run()
\ No newline at end of file
+    napari.run()
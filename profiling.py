@@ -0,0 +1,98 @@
+import csv
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource                             # unix only
+except ImportError:
+    resource = None
+
+class profiler:
+    # wall time, CPU time and peak memory of named pipeline stages.
+    # peak memory is what numpy/python allocated above the stage's starting point
+    # (tracemalloc); maxrss is the process high-water mark when the stage ended.
+    # both are process-wide, so stages running concurrently share them.
+
+    fields = ['stage', 'wall', 'cpu', 'peak', 'maxrss']
+
+    def __init__(self, enabled = True, memory = True, **tags):
+        self.enabled = enabled
+        self.memory = memory
+        self.tags = tags                        # added to every record (e.g. file)
+        self.records = []
+        self.local = threading.local()          # open stages, per thread (stages may nest)
+        self.lock = threading.Lock()
+        self.depth = 0                          # stages open, in any thread
+        self.tracing = False                    # this profiler started tracemalloc
+
+    def __repr__(self):
+        return '\n'.join(f"{i['stage']}: {i['wall']:.3f} s wall, {i['cpu']:.3f} s cpu, {i['peak'] / 2**20:.1f} MiB peak"
+                         for i in self.records)
+
+    def sync(self):
+        # carry the current tracemalloc peak into every open stage before it is reset.
+
+        peak = tracemalloc.get_traced_memory()[1]
+        for frame in getattr(self.local, 'open', []):
+            frame['peak'] = max(frame['peak'], peak)
+
+    @contextmanager
+    def stage(self, name, **tags):
+        if not self.enabled:
+            yield
+            return
+
+        with self.lock:
+            if self.memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.tracing = True             # started here: stopped when the last stage closes
+            self.depth += 1
+        if not hasattr(self.local, 'open'):
+            self.local.open = []
+
+        if self.memory:
+            self.sync()
+            tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0] if self.memory else 0
+        frame = {'peak': base}
+        self.local.open.append(frame)
+        wall, cpu = time.perf_counter(), time.process_time()
+
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            if self.memory:
+                self.sync()
+            self.local.open.pop()
+
+            record = {'stage': name, **self.tags, **tags,
+                      'wall': wall,
+                      'cpu': cpu,
+                      'peak': frame['peak'] - base,
+                      'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else None}
+            with self.lock:
+                self.records.append(record)
+                self.depth -= 1
+                if self.depth == 0 and self.tracing:
+                    tracemalloc.stop()          # later, unprofiled work runs untraced
+                    self.tracing = False
+
+    def write(self, path):
+        # write records to path + '.json' and path + '.csv'.
+
+        with open(path + '.json', 'w') as file:
+            json.dump(self.records, file, indent=1, default=str)
+
+        tags = sorted({key for i in self.records for key in i} - set(profiler.fields))
+        with open(path + '.csv', 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=['stage'] + tags + profiler.fields[1:])
+            writer.writeheader()
+            writer.writerows(self.records)
+
+        return path
+
+off = profiler(enabled = False)                 # default: stages cost nothing
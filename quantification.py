@@ -1,8 +1,32 @@
 import numpy as np
-import pandas as pd
-import scipy as sp
+from association import index, rows
+from segmentation import features
 
 class quantify:
+    # cached intermediates and the attributes/intermediates each one depends on.
+    # setting an attribute drops only the entries downstream of it.
+    depends = {
+        'puncta1_features': ('centroids_puncta1', 'area_puncta1', 'spacing'),
+        'puncta2_features': ('centroids_puncta2', 'area_puncta2', 'spacing'),
+        'cells_features': ('centroids_cells', 'area_cells', 'spacing'),
+        'puncta1': ('puncta1_features', 'puncta1_min', 'puncta1_max'),
+        'puncta2': ('puncta2_features', 'puncta1_min', 'puncta1_max'),
+        'cells': ('cells_features', 'cells_min', 'cells_max'),
+        'puncta1_index': ('puncta1',),
+        'puncta2_index': ('puncta2',),
+        'cells_index': ('cells',),
+        'owners': ('cells', 'puncta1', 'membership', 'cell_labels', 'puncta1_labels'),
+        'cells_neighbors': ('cells_index', 'puncta1_index', 'dist', 'owners'),
+        'puncta2_neighbors': ('puncta1_index', 'puncta2_index', 'threshold'),
+        'overlaps': ('puncta1', 'puncta2', 'puncta1_labels', 'puncta2_labels'),
+        'partners': ('puncta2_neighbors', 'overlaps', 'colocalization'),
+        'count': ('cells_neighbors',),
+        'volume': ('cells_neighbors', 'puncta1'),
+        'coloc': ('cells_neighbors', 'partners'),
+        'cell_manders': ('cells', 'puncta1', 'puncta2', 'cells_neighbors', 'overlaps',
+                         'cell_labels', 'puncta1_labels', 'puncta2_labels'),
+    }
+
     def __init__(self,
                  centroids_puncta1,
                  area_puncta1,
@@ -16,8 +40,14 @@ class quantify:
                  cell_min = 200000,
                  cell_max = 5000000,
                  dist = None,
-                 spacing = None):
-
+                 spacing = None,
+                 membership = 'distance',       # 'distance', or 'centroid'/'overlap' in cell_labels
+                 cell_labels = None,            # cell label volume (speckles of segment_cells)
+                 puncta1_labels = None,         # puncta1 label volume, for membership/colocalization 'overlap'
+                 colocalization = 'distance',   # 'distance' (centroids within threshold) or 'overlap' (shared voxels)
+                 puncta2_labels = None):        # puncta2 label volume, for colocalization='overlap'
+
+        self.cache = {}
         self.centroids_puncta1 = centroids_puncta1
         self.area_puncta1 = area_puncta1
         self.centroids_puncta2 = centroids_puncta2
@@ -31,7 +61,34 @@ class quantify:
         self.cells_max = cell_max
         self.dist = dist
         self.spacing = spacing
-
+        self.membership = membership
+        self.cell_labels = cell_labels
+        self.puncta1_labels = puncta1_labels
+        self.colocalization = colocalization
+        self.puncta2_labels = puncta2_labels
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name != 'cache':
+            self.invalidate(name)
+
+    def invalidate(self, name):
+        # drop cached entries that depend (directly or transitively) on name.
+
+        stale = [name]
+        while stale:
+            changed = stale.pop()
+            for key, inputs in quantify.depends.items():
+                if changed in inputs:
+                    self.cache.pop(key, None)
+                    stale.append(key)
+
+    def cached(self, key, compute):
+        # compute key once; reused until one of its inputs changes.
+
+        if key not in self.cache:
+            self.cache[key] = compute()
+        return self.cache[key]
 
     def __repr__(self):
         _, average_count = quantify.count(self)
@@ -42,175 +99,312 @@ average LD count per cell: {np.mean(average_count)}
 average LD volume per cell: {np.mean(average_volume)}
 colocalization: {np.mean(average_coloc)}''')
 
-    def filter(self, centroids, area, min, max):
-        # remove smallest and largest features
-
-        filtered_area = area[area>min].replace("nan", np.nan).dropna(ignore_index=False)
-        filtered_area = filtered_area[filtered_area<max].replace("nan", np.nan).dropna(ignore_index=False)
-
-        filtered_centroids = centroids.loc[filtered_area.index]
-
-        return filtered_centroids, filtered_area
+    def filter(self, table, min, max):
+        # remove smallest and largest features (one mask; unmeasured regions never pass).
+
+        return table[(table['voxels'] > min) & (table['voxels'] < max)]
+
+    def features(self, kind):
+        # segmentation.features table of 'puncta1', 'puncta2' or 'cells', built once.
+
+        centroids, area = getattr(self, 'centroids_' + kind), getattr(self, 'area_' + kind)
+        return self.cached(kind + '_features', lambda: features(centroids, area, self.spacing))
+
+    def filtered(self, kind):
+        # features of 'puncta1', 'puncta2' or 'cells' within their size bounds, computed once.
+        # puncta2 is filtered with the puncta1 bounds.
+
+        bounds = {'puncta1': ('puncta1_min', 'puncta1_max'),
+                  'puncta2': ('puncta1_min', 'puncta1_max'),
+                  'cells': ('cells_min', 'cells_max')}
+        min, max = (getattr(self, i) for i in bounds[kind])
+
+        return self.cached(kind, lambda: quantify.filter(self, self.features(kind), min, max))
+
+    def tree(self, kind):
+        # KD-tree over the filtered centroids of kind, built once.
+
+        return self.cached(kind + '_index', lambda: index(self.filtered(kind)['centroid']))
+
+    def cells_neighbors(self):
+        # CSR: puncta1 IDs within dist of each cell, or inside it (membership 'centroid'/'overlap').
+
+        if self.membership == 'distance':
+            return self.cached('cells_neighbors',
+                               lambda: self.tree('cells').neighbors(self.tree('puncta1'), self.dist))
+
+        def compute():
+            owner, _ = self.owners()
+            inside = np.flatnonzero(owner >= 0)
+            indices = inside[np.argsort(owner[inside], kind='stable')]
+            indptr = np.zeros(len(self.filtered('cells')) + 1, dtype=np.intp)
+            np.cumsum(np.bincount(owner[inside], minlength=len(indptr) - 1), out=indptr[1:])
+            return indptr, indices
+
+        return self.cached('cells_neighbors', compute)
+
+    def owners(self):
+        # (cell, fraction) of each filtered puncta1, from the cell label volume: the cell (position
+        # among filtered cells, -1 for none) under its centroid ('centroid'), or the cell holding most
+        # of its voxels ('overlap'), and the fraction of its voxels inside that cell.
+        # every punctum belongs to at most one cell, whatever the density.
+
+        return self.cached('owners', self._owners)
+
+    def _owners(self):
+        if self.membership not in ('centroid', 'overlap'):
+            raise ValueError(f"membership must be 'distance', 'centroid' or 'overlap', not {self.membership!r}")
+        if self.cell_labels is None or (self.membership == 'overlap' and self.puncta1_labels is None):
+            raise ValueError(f'membership {self.membership!r} needs cell_labels'
+                             + (' and puncta1_labels' if self.membership == 'overlap' else ''))
+
+        cells = self.filtered('cells')
+        lookup = positions(cells['label'], len(self.area_cells))
+        puncta = self.filtered('puncta1')
+
+        if self.membership == 'centroid':
+            coords = np.rint(puncta['centroid']).astype(np.intp)
+            coords = np.clip(coords, 0, np.array(self.cell_labels.shape) - 1)
+            owner = lookup[np.asarray(self.cell_labels[tuple(coords.T)])]
+            return owner, (owner >= 0).astype(float)
+
+        # sparse punctum x cell co-occurrence over the puncta1 voxels.
+        found = np.nonzero(self.puncta1_labels)
+        punctum = positions(puncta['label'], len(self.area_puncta1))[np.asarray(self.puncta1_labels[found])]
+        cell = lookup[np.asarray(self.cell_labels[found])]
+        del found
+
+        size = np.bincount(punctum[punctum >= 0], minlength=len(puncta))
+        inside = (punctum >= 0) & (cell >= 0)
+        pairs, overlap = np.unique(punctum[inside] * len(cells) + cell[inside], return_counts=True)
+        punctum, cell = np.divmod(pairs, max(len(cells), 1))
+
+        # the largest overlap of each punctum (ties: lowest-numbered cell).
+        order = np.lexsort((cell, -overlap, punctum))
+        first = order[np.r_[True, punctum[order][1:] != punctum[order][:-1]]] if len(order) else order
+        owner = np.full(len(puncta), -1, dtype=np.intp)
+        fraction = np.zeros(len(puncta))
+        owner[punctum[first]] = cell[first]
+        fraction[punctum[first]] = overlap[first] / size[punctum[first]]
+        return owner, fraction
+
+    def puncta2_neighbors(self):
+        # CSR: puncta2 IDs within threshold of each puncta1.
+
+        return self.cached('puncta2_neighbors',
+                           lambda: self.tree('puncta1').neighbors(self.tree('puncta2'), self.threshold))
+
+    def partners(self):
+        # position (among filtered puncta2) of the partner of each filtered puncta1, or -1:
+        # the lowest-numbered puncta2 within threshold, or (colocalization 'overlap') the one
+        # sharing most voxels with it.
+
+        def compute():
+            if self.colocalization == 'overlap':
+                puncta1, puncta2, shared = self.overlaps()
+                order = np.lexsort((puncta2, -shared, puncta1))
+                first = order[np.r_[True, puncta1[order][1:] != puncta1[order][:-1]]] if len(order) else order
+                partner = np.full(len(self.filtered('puncta1')), -1, dtype=np.intp)
+                partner[puncta1[first]] = puncta2[first]
+                return partner
+
+            puncta2_indptr, puncta2_indices = self.puncta2_neighbors()
+            has_partner = np.diff(puncta2_indptr) > 0
+            partner = np.full(len(puncta2_indptr) - 1, -1, dtype=np.intp)
+            partner[has_partner] = puncta2_indices[puncta2_indptr[:-1][has_partner]]
+            return partner
+
+        return self.cached('partners', compute)
+
+    def overlaps(self):
+        # sparse puncta1 x puncta2 co-occurrence: (puncta1, puncta2, shared voxels) for every pair
+        # of filtered puncta sharing voxels, from one pass over the puncta1 foreground.
+
+        def compute():
+            if self.puncta1_labels is None or self.puncta2_labels is None:
+                raise ValueError('voxel overlap needs puncta1_labels and puncta2_labels')
+            puncta1 = self.filtered('puncta1')
+            puncta2 = self.filtered('puncta2')
+
+            found = np.nonzero(self.puncta1_labels)
+            first = positions(puncta1['label'], len(self.area_puncta1))[np.asarray(self.puncta1_labels[found])]
+            second = positions(puncta2['label'], len(self.area_puncta2))[np.asarray(self.puncta2_labels[found])]
+            both = (first >= 0) & (second >= 0)
+
+            pairs, shared = np.unique(first[both] * max(len(puncta2), 1) + second[both], return_counts=True)
+            first, second = np.divmod(pairs, max(len(puncta2), 1))
+            return first, second, shared
+
+        return self.cached('overlaps', compute)
+
+    def manders(self):
+        # voxel Manders coefficients per punctum: the fraction of each filtered puncta1 covered
+        # by puncta2 (M1), and of each filtered puncta2 covered by puncta1 (M2).
+
+        puncta1, puncta2, shared = self.overlaps()
+        size1 = self.filtered('puncta1')['voxels']
+        size2 = self.filtered('puncta2')['voxels']
+        m1 = np.bincount(puncta1, weights=shared, minlength=len(size1)) / size1
+        m2 = np.bincount(puncta2, weights=shared, minlength=len(size2)) / size2
+        return m1, m2
+
+    def cell_manders(self):
+        # voxel Manders coefficients per filtered cell: puncta1 voxels of the cell covered by
+        # puncta2 (M1) and puncta2 voxels covered by puncta1 (M2). with cell_labels the voxels
+        # are counted inside each cell; otherwise (M1 only, M2 NaN) over the puncta1 assigned to it.
+        # computed once (it passes over the whole label volumes).
+
+        return self.cached('cell_manders', self._cell_manders)
+
+    def _cell_manders(self):
+
+        cells = self.filtered('cells')
+        if self.cell_labels is None:
+            size1 = self.filtered('puncta1')['voxels']
+            puncta1, _, shared = self.overlaps()
+            covered, _ = self.per_cell(np.bincount(puncta1, weights=shared, minlength=len(size1)))
+            total, _ = self.per_cell(size1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return covered / total, np.full(len(cells), np.nan)
+
+        lookup = positions(cells['label'], len(self.area_cells))
+        counts = []
+        puncta1 = (self.puncta1_labels, positions(self.filtered('puncta1')['label'], len(self.area_puncta1)))
+        puncta2 = (self.puncta2_labels, positions(self.filtered('puncta2')['label'], len(self.area_puncta2)))
+        for (labels, kept_labels), (other, kept_other) in ((puncta1, puncta2), (puncta2, puncta1)):
+            found = np.nonzero(labels)
+            kept = kept_labels[np.asarray(labels[found])] >= 0
+            cell = lookup[np.asarray(self.cell_labels[found])]
+            inside = kept & (cell >= 0)
+            # covered only by puncta that pass the size filter, as in overlaps()/manders().
+            covers = kept_other[np.asarray(other[found])] >= 0
+            total = np.bincount(cell[inside], minlength=len(cells))
+            covered = np.bincount(cell[inside & covers], minlength=len(cells))
+            counts.append((covered, total))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return tuple(covered / total for covered, total in counts)
+
+    def cell_records(self, batch = 2**20):
+        # per-cell rows, batch at a time: cell (row of the cell table), centroid, puncta1 count,
+        # mean puncta1 volume (µm^3, NaN without puncta1), puncta1 with a puncta2 partner and,
+        # with colocalization 'overlap', the cell's Manders coefficients (NaN otherwise).
+
+        cells = self.filtered('cells')
+        total, count = self.per_cell(self.filtered('puncta1')['volume'])
+        partnered, _ = self.per_cell(self.partners() >= 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+
+        centroids = cells['centroid']
+        cells = cells['label'] - 1
+        m1, m2 = self.cell_manders() if self.colocalization == 'overlap' else (np.full(len(count), np.nan),) * 2
+        for start in range(0, max(len(count), 1), batch):      # one empty batch without cells
+            rows = slice(start, start + batch)
+            yield {'cell': cells[rows],
+                   'z': centroids[rows, 0], 'y': centroids[rows, 1], 'x': centroids[rows, 2],
+                   'count': count[rows],
+                   'volume': mean[rows],
+                   'partnered': partnered[rows].astype(np.int64),
+                   'm1': m1[rows],
+                   'm2': m2[rows]}
+
+    def puncta_records(self, batch = 2**20):
+        # per-punctum rows, batch at a time: punctum and cell (rows of their tables; a punctum
+        # within dist of several cells appears once per cell, one outside every cell once with
+        # cell -1), centroid, volume (µm^3), puncta2 partner (-1 if none) and, with label
+        # membership, the fraction of the punctum inside its cell, and with colocalization 'overlap',
+        # the fraction covered by puncta2 (m1; both NaN otherwise).
+
+        puncta1 = self.filtered('puncta1')
+        indptr, indices = self.cells_neighbors()
+
+        outside = np.setdiff1d(np.arange(len(puncta1)), indices)
+        puncta = np.concatenate([indices, outside])
+        owner = np.concatenate([np.repeat(self.filtered('cells')['label'] - 1, np.diff(indptr)), np.full(len(outside), -1)])
+
+        ids = puncta1['label'] - 1
+        puncta2_ids = np.append(self.filtered('puncta2')['label'] - 1, -1)     # position -1 -> id -1
+        partner = self.partners()
+        centroids = puncta1['centroid']
+        volume = puncta1['volume']
+        fraction = self.owners()[1] if self.membership != 'distance' else np.full(len(ids), np.nan)
+        m1 = self.manders()[0] if self.colocalization == 'overlap' else np.full(len(ids), np.nan)
+
+        for start in range(0, max(len(puncta), 1), batch):     # one empty batch without puncta
+            rows = puncta[start:start + batch]
+            yield {'punctum': ids[rows],
+                   'cell': owner[start:start + batch],
+                   'z': centroids[rows, 0], 'y': centroids[rows, 1], 'x': centroids[rows, 2],
+                   'volume': volume[rows],
+                   'partner': puncta2_ids[partner[rows]],
+                   'overlap': fraction[rows],
+                   'm1': m1[rows]}
 
     def count(self):
+        return self.cached('count', self._count)
 
-        # filter smallest and largest features.
-        filtered_centroids_puncta1, filtered_area_puncta1 = quantify.filter(self,
-                                                                  self.centroids_puncta1,
-                                                                  self.area_puncta1,
-                                                                  self.puncta1_min,
-                                                                  self.puncta1_max)
-
-        filtered_centroids_cells, filtered_area_cells = quantify.filter(self,
-                                                                    self.centroids_cells,
-                                                                    self.area_cells,
-                                                                    self.cells_min,
-                                                                    self.cells_max)
-
-        # compute distance matrix between centroids.
-        dist_matrix = pd.DataFrame(sp.spatial.distance_matrix(filtered_centroids_cells,
-                                                              filtered_centroids_puncta1))
-
-        # get values from distance matrix below dist.
-        neighbors = np.array(dist_matrix < self.dist)
-
-        # create dictionary: keys are cell IDs, values are lists of puncta1 IDs.
-        count = {}
-
-        # add puncta1's within specified distance of cell to value associated with cell key.
-        for i in range(neighbors.shape[0]):
-            count[i] = []
-            id = []
-            for j in range(neighbors.shape[1]):
-                if neighbors[i, j]:
-                    id.append(j)
-                count[i] = id
+    def _count(self):
 
-        # create list of number of puncta1's per cell.
-        average_count = []
+        # radius query between cell and puncta1 centroids (CSR: puncta1 IDs per cell).
+        cells_neighbors = self.cells_neighbors()
 
-        for i in range(len(count)):
-            average_count.append(len(count[i]))
+        # create dictionary: keys are cell IDs, values are lists of puncta1 IDs within dist of the cell.
+        count = rows(*cells_neighbors)
 
-        average_count = np.array(average_count)[~np.isnan(np.array(average_count))]
+        # create list of number of puncta1's per cell.
+        average_count = np.diff(cells_neighbors[0])
 
         # count : dictionary. keys = cell ID, values = puncta1 IDs.
         # average_count : list of average puncta1 count per cell.
         return count, average_count
 
     def volume(self):
+        return self.cached('volume', self._volume)
 
-        # filter largest and smallest features
-        filtered_centroids_puncta1, filtered_area_puncta1 = quantify.filter(self,
-                                                                  self.centroids_puncta1,
-                                                                  self.area_puncta1,
-                                                                  self.puncta1_min,
-                                                                  self.puncta1_max)
-
-        filtered_centroids_cells, filtered_area_cells = quantify.filter(self,
-                                                                    self.centroids_cells,
-                                                                    self.area_cells,
-                                                                    self.cells_min,
-                                                                    self.cells_max)
-
-        # scale area size from pixels to mcirons
-        scale = self.spacing[0] * self.spacing[1] * self.spacing[2]
-        filtered_area_puncta1 = filtered_area_puncta1 * scale
+    def _volume(self):
 
-        # get puncta1's sorted by cell
-        count, _ = quantify.count(self)
+        # puncta1 volumes (µm^3, from the feature table) in cell order.
+        indptr, indices = self.cells_neighbors()
+        volumes = self.filtered('puncta1')['volume']
 
-        volume = {}
+        # volume per cell: one slice of the CSR each.
+        volume = dict(enumerate(np.split(volumes[indices], indptr[1:-1])))
 
-        # add area of puncta1's to value associated with cell key
-        for i in count.items():
-            cell = []
-            for j in i[1]:
-                area = filtered_area_puncta1.iloc[j][0]
-                cell.append(area)
-            volume[i[0]] = cell
-
-        # get list of average puncta1 volume per cell
-        average_volume = []
-        for i in volume.values():
-            average_volume.append(np.mean(i))
-
-        average_volume = np.array(average_volume)[~np.isnan(np.array(average_volume))]
+        # average puncta1 volume per cell (cells without puncta1 are skipped).
+        total, count = self.per_cell(volumes)
+        average_volume = total[count > 0] / count[count > 0]
 
         # volume : dictionary. keys = cell ID. values = puncta1 volumes.
-        # average_volume : list of average puncta1 volume per cell.
+        # average_volume : array of average puncta1 volume per cell.
         return volume, average_volume
 
     def coloc(self):
+        return self.cached('coloc', self._coloc)
+
+    def _coloc(self):
+
+        # puncta1 with a puncta2 partner (cached radius query or voxel overlap), counted per cell.
+        partnered, count = self.per_cell(self.partners() >= 0)
+
+        # divide the number of overlapped dye by the number of puncta1's per cell (cells without puncta1 are skipped).
+        average_coloc = partnered[count > 0] / count[count > 0]
 
-        # filter smallest and largest features.
-        filtered_centroids_puncta1, filtered_area_puncta1 = quantify.filter(self,
-                                                                  self.centroids_puncta1,
-                                                                  self.area_puncta1,
-                                                                  self.puncta1_min,
-                                                                  self.puncta1_max)
-
-        filtered_centroids_cells, filtered_area_cells = quantify.filter(self,
-                                                                    self.centroids_cells,
-                                                                    self.area_cells,
-                                                                    self.cells_min,
-                                                                    self.cells_max)
-
-        filtered_centroids_puncta2, filtered_area_puncta2 = quantify.filter(self,
-                                                                  self.centroids_puncta2,
-                                                                  self.area_puncta2,
-                                                                  self.puncta1_min,
-                                                                  self.puncta1_max)
-
-        # compute distance matrix between cells and puncta1 centroids.
-        cells_dist_matrix = pd.DataFrame(sp.spatial.distance_matrix(filtered_centroids_puncta1,
-                                                                  filtered_centroids_cells))
-
-        # get values from distance matrix below dist.
-        cells_neighbors = np.array(cells_dist_matrix < self.dist)
-
-        # compute distance matrix between LD and lipid dye centroids.
-        puncta2_dist_matrix = pd.DataFrame(sp.spatial.distance_matrix(filtered_centroids_puncta1,
-                                                                 filtered_centroids_puncta2))
-
-        puncta2_neighbors = np.array(puncta2_dist_matrix < self.dist)
-
-        # get values from distance matrix below threshold.
-        dye_neighbors = np.array(puncta2_dist_matrix < self.threshold)
-
-        # create dictionaries: keys are cell IDs, values are puncta1/puncta2 IDs associated with each cell.
-        puncta2_count_per_cell = {}
-        puncta1_count_per_cell = {}
-
-        for i in range(cells_neighbors.shape[1]):
-            puncta2_count_per_cell[i] = []
-            puncta1_count_per_cell[i] = []
-
-        # create dictionary of puncta1 count per cell.
-        for i in range(cells_neighbors.shape[1]):
-            puncta1_count = []
-            for j in range(cells_neighbors.shape[0]):
-                if cells_neighbors[j, i]:
-                    puncta1_count.append(j)
-            puncta1_count_per_cell[i] = puncta1_count
-
-        # create dictionary of overlapped puncta2 count per cell.
-        for i in puncta1_count_per_cell.items():
-            puncta2_count = []
-            for j in i[1]:
-                for k in range(puncta2_neighbors.shape[1]):
-                    if puncta2_neighbors[j, k]:
-                        puncta2_count.append(k)
-                        break
-            puncta2_count_per_cell[i[0]] = puncta2_count
-
-        # divide the number of overlapped dye by the number of puncta1's per cell.
-        average_coloc = []
-        for i in range(len(puncta2_count_per_cell)):
-            try:
-                average_coloc.append(len(puncta2_count_per_cell[i]) / len(puncta2_count_per_cell[i]))
-            except:
-                continue
-
-        # average_coloc : list of colocalization (# overlapped with x / total # x) per cell.
+        # average_coloc : array of colocalization (# overlapped with x / total # x) per cell.
         return average_coloc
+
+    def per_cell(self, values):
+        # (sum of values over the puncta1 of each cell, puncta1 count): values holds one entry
+        # per filtered puncta1; one bincount over the CSR assignment.
+
+        indptr, indices = self.cells_neighbors()
+        count = np.diff(indptr)
+        owner = np.repeat(np.arange(len(count)), count)
+        return np.bincount(owner, weights=np.asarray(values, dtype=float)[indices], minlength=len(count)), count
+
+def positions(labels, n):
+    # label (1..n) -> position among the filtered labels, or -1 for filtered-out labels and background.
+
+    lookup = np.full(n + 1, -1, dtype=np.intp)
+    lookup[np.asarray(labels)] = np.arange(len(labels))
+    return lookup
@@ -1,28 +1,44 @@
 import numpy as np
-import scipy as sp
 from scipy import ndimage as ndi
 import pandas as pd
 import skimage
 from skimage import filters, morphology, measure, segmentation
-import time
+from loading import stack, open_stack
+import tiling
+import profiling
 
 class img:
     # thresholding, morphological operations, segmentation.
 
-    def __init__(self, file, channel, sigma, width, spacing, pixels):
-        self.img = skimage.io.imread(file)
+    def __init__(self, file, channel, sigma, width, spacing, pixels, block = None, profile = None, precision = None,
+                 threads = None, approximate = None, downsample = None, li_factor = None):
+        self.stack = open_stack(file)                       # filename or shared loading.stack
+        self.img = self.stack.channel(channel)              # zero-copy (z, y, x) view
         self.idx = channel
         self.sigma = sigma
         self.width = width
         self.original_spacing = np.array([spacing[0]/pixels[0], (spacing[1]/pixels[1]), (spacing[2]/pixels[2])])
+        self.block = block                                  # block size (z, y, x) for out-of-core processing; None = in memory
+        self.profile = profile or profiling.off             # per-stage timing and peak memory
+        self.precision = precision and np.dtype(precision)  # e.g. float32: compact intermediates and labels; None = float64
+        self.threads = threads or 1                         # threads per filter (slabs of the volume)
+        self.approximate = approximate                      # sigma from which the Gaussian is approximated by box filters
+        self.li_factor = 1 if li_factor is None else li_factor  # edge threshold as a multiple of Li's
+        if downsample == 'auto':                            # cells on a coarser grid (z, y, x factors); None = full resolution
+            downsample = coarse_factors(self.original_spacing)
+        if block is not None or downsample is None or np.all(np.asarray(downsample) == 1):
+            self.factors = None                             # (out-of-core blocks run at full resolution)
+        else:
+            self.factors = np.array(downsample, dtype=int)
 
     def __repr__(self):
 
-        data = skimage.util.img_as_float(self.img[:, :, :, self.idx])
+        # convert only the extremes so printing doesn't allocate a float copy of the channel.
+        extremes = skimage.util.img_as_float(np.array([self.img.min(), self.img.max()], dtype=self.img.dtype))
 
-        info = f'''shape: {data.shape}
-dtype: {data.dtype}
-range: ({data.min()}, {data.max()})
+        info = f'''shape: {self.img.shape}
+dtype: {extremes.dtype}
+range: ({extremes[0]}, {extremes[1]})
 microscope spacing: {self.original_spacing}'''
 
         if self.idx == 0:
@@ -32,142 +48,513 @@ microscope spacing: {self.original_spacing}'''
         elif self.idx == 2:
             return ("red channel\n" + info)
 
+    def stage(self, name):
+        # profile a named step of this channel.
+
+        return self.profile.stage(name, channel=self.idx)
+
+    def buffer(self, shape = None):
+        # intermediate volume in the working precision (None: let each filter pick its dtype).
+
+        return None if self.precision is None else np.empty(shape or self.img.shape, dtype=self.precision)
+
+    def gaussian(self, image, sigma = None):
+        # Gaussian filter (output in the working precision, else image's dtype, as scipy's):
+        # scipy's, split across threads, or box filters once sigma reaches self.approximate.
+
+        sigma = self.sigma if sigma is None else sigma
+        approximate = self.approximate is not None and np.max(sigma) >= self.approximate
+        out = self.buffer(image.shape)
+        if self.threads == 1 and not approximate:
+            return ndi.gaussian_filter(image, sigma=sigma, output=out)
+
+        out = np.empty(image.shape, dtype=image.dtype) if out is None else out
+        if approximate:
+            return tiling.box_gaussian(image, sigma, out, self.threads)
+        return tiling.gaussian(image, sigma, out, self.threads)
+
+    def median(self, image, size = 3):
+        # median filter, on overlapping slabs when threaded.
+
+        out = self.buffer()
+        if self.threads == 1:
+            return ndi.median_filter(image, size=size, output=out)
+
+        out = np.empty(image.shape, dtype=image.dtype) if out is None else out
+        return tiling.parallel(lambda block: ndi.median_filter(block, size=size), image, out, self.threads, halo=size // 2)
+
+    def sobel(self, image, out):
+        # Sobel edge magnitude: skimage's, or the separable one writing into out.
+
+        if self.precision is None:
+            if self.threads == 1:
+                return filters.sobel(image)
+            out = np.empty(image.shape, dtype=np.float32 if image.dtype.itemsize <= 4 and image.dtype.kind == 'f' else float)
+            return tiling.parallel(filters.sobel, image, out, self.threads, halo=1)
+        scale = 1 / np.iinfo(self.img.dtype).max if self.img.dtype.kind in 'iu' else 1     # as img_as_float
+        return sobel(image, out, scale, self.threads)
+
+    def label(self, mask):
+        # connected components (connectivity 3), in the smallest integer type when compact.
+
+        if self.precision is None:
+            return measure.label(mask, connectivity = 3)
+        labels = np.empty(mask.shape, dtype=np.int32)
+        ndi.label(mask, structure=ndi.generate_binary_structure(mask.ndim, mask.ndim), output=labels)
+        return shrink(labels)
+
+    def distance_transform(self, labels, spacing):
+        # Euclidean distance transform of labels. scipy only writes float64, so the compact
+        # mode transforms object by object (exactly, see tiling.distance_transform) into a float32 volume.
+
+        if self.precision is None:
+            return ndi.distance_transform_edt(labels, sampling = spacing)
+        transformed = np.zeros(labels.shape, dtype=self.precision)
+        return tiling.distance_transform(labels, transformed, ndi.find_objects(labels), spacing)
+
     def threshold_cells(self):
         # thresholding and morphological operations for cells.
 
-        spacing = self.original_spacing / self.original_spacing[2]  # scale spacing
-        img = self.img[:, :, :, self.idx]
-        gaussian = ndi.gaussian_filter(                             # Gaussian filter
-            img,
-            sigma=self.sigma)
-        edges = filters.sobel(gaussian)                             # Sobel filter for edge detection
-        thresholded = edges > filters.threshold_li(edges)           # binary thresholding (Li)
-        fill_holes = ndi.binary_fill_holes(thresholded)             # fill in cells
-        eroded = morphology.isotropic_erosion(                      # binary morphological erosion
-            fill_holes,
-            radius = self.width/2)
-        dilated = morphology.isotropic_dilation(                    # binary morphological dilation
-            eroded,
-            radius = self.width/2)
+        if self.block is not None:
+            return self.threshold_cells_tiled()
+        if self.factors is not None:
+            return self.threshold_cells_coarse()
+
+        return self.objects(self.clean(self.mask(self.edges())))
+
+    def threshold_cells_coarse(self):
+        # threshold_cells on block means of self.factors voxels. sigma and the erosion/dilation
+        # radius keep their full-resolution size (in voxels), so only the sampling changes.
+        # returns the coarse volumes; segment_cells brings its results back to full resolution.
+
+        factors = self.factors
+        spacing = self.original_spacing / self.original_spacing[2] * factors    # scale spacing
+        with self.stage('downsample'):
+            coarse = downsample(self.img, factors, self.precision or float)
+        with self.stage('gaussian'):
+            gaussian = self.gaussian(coarse, sigma = self.sigma / factors)      # Gaussian filter
+        with self.stage('sobel'):
+            edges = filters.sobel(gaussian)                                     # Sobel filter for edge detection
+            del gaussian
+        thresholded = edges > self.cutoff(edges)                                # binary thresholding (Li)
+        with self.stage('fill_holes'):
+            fill_holes = ndi.binary_fill_holes(thresholded)                     # fill in cells
+        with self.stage('erosion'):
+            eroded = tiling.erosion(fill_holes, self.width/2, sampling = factors)   # binary morphological erosion
+        with self.stage('dilation'):
+            dilated = tiling.dilation(eroded, self.width/2, sampling = factors)     # binary morphological dilation
 
         print(f'distance transformation...')
-        labels = measure.label(                                     # labeling
-            dilated,
-            connectivity = 3)
-        transformed = ndi.distance_transform_edt(                   # distance transformation
-            labels,
-            sampling = spacing)
+        with self.stage('label'):
+            labels = self.label(dilated)                                        # labeling
+        with self.stage('distance_transform'):
+            transformed = self.distance_transform(labels, spacing)              # distance transformation
 
         return transformed, labels
 
+    def upsample(self, volume):
+        # full-resolution (nearest neighbour) copy of a coarse volume.
+
+        return upsample(volume, self.factors, self.img.shape)
+
     def threshold_puncta(self):
         # thresholding and morphological operations for puncta.
 
+        if self.block is not None:
+            return self.threshold_puncta_tiled()
+
+        print(f'thresholding...')
+        return self.objects(self.clean(self.mask(self.edges())))
+
+    def edges(self, sigma = None):
+        # edge map thresholded by threshold_cells/threshold_puncta: Gaussian filter (then a median
+        # filter, for puncta) and Sobel filter. depends on sigma only.
+
+        img = self.img
+        with self.stage('gaussian'):
+            gaussian = self.gaussian(img, sigma)                    # Gaussian filter
+        if self.idx == 0:
+            with self.stage('sobel'):
+                return self.sobel(gaussian, self.buffer())          # Sobel filter for edge detection
+        with self.stage('median'):
+            denoised = self.median(gaussian, size = 3)              # median filter
+        with self.stage('sobel'):
+            return self.sobel(denoised, gaussian)                   # Sobel filter (reuses the Gaussian buffer)
+
+    def cutoff(self, edges):
+        # edge threshold: self.li_factor times Li's.
+
+        with self.stage('threshold_li'):
+            return self.li_factor * filters.threshold_li(edges)
+
+    def mask(self, edges, cutoff = None):
+        # binary thresholding of an edge map; cells are filled in. doesn't depend on width.
+
+        cutoff = self.cutoff(edges) if cutoff is None else cutoff
+        thresholded = edges > cutoff                                # binary thresholding (Li)
+        if self.idx != 0:
+            return thresholded
+        with self.stage('fill_holes'):
+            return ndi.binary_fill_holes(thresholded)               # fill in cells
+
+    def clean(self, mask, width = None):
+        # morphological operations sized by width: opening (erosion, dilation) for cells,
+        # removal of small holes and objects (closing, opening) for puncta.
+
+        width = self.width if width is None else width
+        if self.idx == 0:
+            with self.stage('erosion'):
+                eroded = morphology.isotropic_erosion(mask, radius = width/2)      # binary morphological erosion
+            with self.stage('dilation'):
+                return morphology.isotropic_dilation(eroded, radius = width/2)     # binary morphological dilation
+        with self.stage('remove_small_holes'):
+            remove_holes = morphology.remove_small_holes(mask, area_threshold = width**3)  # morphological closing
+        with self.stage('remove_small_objects'):
+            return morphology.remove_small_objects(remove_holes, min_size = width**3)    # morphological opening
+
+    def objects(self, mask):
+        # labels of a cleaned mask and their distance transform (the watershed input).
+
+        print(f'distance transformation...')
+        spacing = self.original_spacing / self.original_spacing[2]  # scale spacing
+        with self.stage('label'):
+            labels = self.label(mask)                               # labeling
+        with self.stage('distance_transform'):
+            transformed = self.distance_transform(labels, spacing)  # distance transformation
+
+        return transformed, labels
+
+    def threshold_cells_tiled(self):
+        # threshold_cells over overlapping blocks. halos are sized from sigma/width so every
+        # block matches the in-memory result; intermediates live in disk-backed scratch arrays.
+
+        spacing = self.original_spacing / self.original_spacing[2]  # scale spacing
+        img = self.img
+        radius = self.width/2
+        halo = int(4 * self.sigma + 0.5) + 1                        # Gaussian (truncate=4) + Sobel footprint
+
+        with self.stage('gaussian+sobel'):
+            edges = tiling.scratch(img.shape, self.precision or float)                # Gaussian + Sobel filters
+            tiling.apply(lambda b: filters.sobel(ndi.gaussian_filter(b, sigma=self.sigma)),
+                         img, edges, self.block, halo)
+        with self.stage('threshold_li'):
+            li = self.li_factor * tiling.threshold_li(edges, self.block)   # binary thresholding (Li)
+
+        # fill in cells: background components (connectivity 1) not touching the volume border.
+        with self.stage('fill_holes'):
+            background = tiling.scratch(img.shape, np.int32)
+            n = tiling.label(edges, background, self.block, connectivity=1, func=lambda b: b <= li)
+            outside = np.zeros(n + 1, dtype=bool)
+            for axis in range(background.ndim):
+                for face in (0, -1):
+                    outside[np.unique(np.take(background, face, axis=axis))] = True
+            outside[0] = False
+            fill_holes = tiling.scratch(img.shape, bool)
+            tiling.remap(background, fill_holes, ~outside, self.block)
+            del background
+
+        with self.stage('erosion'):
+            eroded = tiling.scratch(img.shape, bool)                # binary morphological erosion
+            tiling.apply(lambda b: tiling.erosion(b, radius), fill_holes, eroded, self.block, int(np.ceil(radius)) + 1)
+        with self.stage('dilation'):
+            dilated = fill_holes                                    # binary morphological dilation (reuses scratch)
+            tiling.apply(lambda b: tiling.dilation(b, radius), eroded, dilated, self.block, int(np.ceil(radius)) + 1)
+
+        print(f'distance transformation...')
+        return self.transform_tiled(dilated, spacing)
+
+    def threshold_puncta_tiled(self):
+        # threshold_puncta over overlapping blocks (see threshold_cells_tiled).
+
         print(f'thresholding...')
         spacing = self.original_spacing / self.original_spacing[2] # scale spacing
-        img = self.img[:, :, :, self.idx]
-        gaussian = ndi.gaussian_filter(                            # Gaussian filter
-            img,
-            sigma = self.sigma
-        )
-        denoised = ndi.median_filter(                              # median filter
-            gaussian,
-            size = 3
-        )
-        edges = filters.sobel(denoised)                         # Sobel filter for edge detection
-        thresholded = edges > filters.threshold_li(edges)     # binary thresholding (Otsu)
-        remove_holes = morphology.remove_small_holes(           # remove holes smaller than area_threshold (morphological closing)
-            thresholded,
-            area_threshold=self.width**3
-        )
-        remove_objects = morphology.remove_small_objects(       # remove objects smaller than area_threshold (morphological opening)
-            remove_holes,
-            min_size=self.width**3)
+        img = self.img
+        halo = int(4 * self.sigma + 0.5) + 2                       # Gaussian + median + Sobel footprints
+
+        with self.stage('gaussian+median+sobel'):
+            edges = tiling.scratch(img.shape, self.precision or float)               # Gaussian, median and Sobel filters
+            tiling.apply(lambda b: filters.sobel(ndi.median_filter(ndi.gaussian_filter(b, sigma=self.sigma), size=3)),
+                         img, edges, self.block, halo)
+        with self.stage('threshold_li'):
+            li = self.li_factor * tiling.threshold_li(edges, self.block)  # binary thresholding (Li)
+
+        # remove holes smaller than width**3 (background components, connectivity 1).
+        with self.stage('remove_small_holes'):
+            components = tiling.scratch(img.shape, np.int32)
+            n = tiling.label(edges, components, self.block, connectivity=1, func=lambda b: b <= li)
+            small = tiling.sizes(components, n, self.block) < self.width**3
+            small[0] = True                                        # label 0 = foreground, kept
+            remove_holes = tiling.scratch(img.shape, bool)
+            tiling.remap(components, remove_holes, small, self.block)
+
+        # remove objects smaller than width**3 (connectivity 1).
+        with self.stage('remove_small_objects'):
+            n = tiling.label(remove_holes, components, self.block, connectivity=1)
+            keep = tiling.sizes(components, n, self.block) >= self.width**3
+            keep[0] = False
+            remove_objects = remove_holes                          # reuses scratch
+            tiling.remap(components, remove_objects, keep, self.block)
+            del components
 
         print(f'distance transformation...')
-        labels = measure.label(                                 # labeling
-            remove_objects,
-            connectivity=3
-        )
-        transformed = ndi.distance_transform_edt(               # distance transformation
-            labels,
-            sampling=spacing
-        )   # distance transformation
+        return self.transform_tiled(remove_objects, spacing)
+
+    def transform_tiled(self, mask, spacing):
+        # labeling and per-object distance transformation of a thresholded (scratch) mask.
+
+        with self.stage('label'):
+            labels = tiling.scratch(mask.shape, np.int32)           # labeling
+            n = tiling.label(mask, labels, self.block, connectivity=3)
+            self.boxes = tiling.find_objects(labels, n, self.block)
+        with self.stage('distance_transform'):
+            transformed = tiling.scratch(mask.shape, self.precision or float)         # distance transformation
+            tiling.distance_transform(labels, transformed, self.boxes, spacing)
 
         return transformed, labels
 
+    def segment_tiled(self, transformed, labels, cells):
+        # segment_cells/segment_puncta object by object: objects are separate components of
+        # the watershed mask, so flooding each bounding box on its own gives the same result.
+
+        with self.stage('markers'):
+            _, coords = tiling.centroids(labels, len(self.boxes), self.block)
+            markers = np.unique(np.array(coords, dtype=int), axis=0)    # marker voxels (raster order)
+
+            if cells:
+                ids = np.ones(len(markers), dtype=np.int32)             # boolean markers: one basin
+            else:
+                ids = tiling.label_points(markers)                      # as ndi.label(mask) numbers them
+
+            owner = np.asarray(labels[tuple(markers.T)]) if len(markers) else np.zeros(0, int)
+
+        with self.stage('watershed'):
+            segmented = tiling.scratch(labels.shape, np.int32)
+            for i in np.unique(owner[owner > 0]):
+                box = self.boxes[i - 1]
+                obj = np.asarray(labels[box]) == i
+                inside = markers[owner == i]
+                marker = np.zeros(obj.shape, dtype=np.int32)
+                marker[tuple((inside - [s.start for s in box]).T)] = ids[owner == i]
+                basins = segmentation.watershed(np.asarray(transformed[box]), markers=marker, mask=obj)
+                segmented[box] = np.where(obj, basins, segmented[box])
+
+        with self.stage('speckles'):
+            speckles = tiling.scratch(labels.shape, np.int32)
+            n = tiling.label(segmented, speckles, self.block, connectivity=3)
+        with self.stage('regions'):
+            area, centroids = tiling.centroids(speckles, n, self.block)
+            self.regions = table(area, centroids)
+        centroids = self.regions[centroid]
+        area = self.regions[['area']]
+
+        return centroids, area, segmented, speckles
+
     def segment_cells(self, transformed, labels):
         # segmenting cells.
 
-        coords = pd.DataFrame(measure.regionprops_table(      # get centroids of labels
-                labels,
-                properties=['centroid']
-                ))
-        mask = np.zeros(transformed.shape, dtype=bool)        # create markers for segmentation (array of basins)
-        for i in np.round(np.array(coords, dtype=int)):
-            j, k, l = i
-            mask[j, k, l] = True
-        markers, num_features = ndi.label(mask)
-        segmented = segmentation.watershed(                   # segmentation
-            transformed,
-            markers=mask,
-            mask=labels                                       # only points where mask==True will be labeled
-        )
-        speckles = measure.label(segmented)
-        centroids = pd.DataFrame(measure.regionprops_table(   # get centroids of labels
-                speckles,
-                properties=['centroid']
-                ))
-        area = pd.DataFrame(measure.regionprops_table(        # get area of labels
-                speckles,
-                properties=['area']
-                ))
+        if self.block is not None:
+            return self.segment_tiled(transformed, labels, cells=True)
+
+        with self.stage('markers'):
+            coords = regions(labels)[centroid]                # get centroids of labels
+            mask = np.zeros(transformed.shape, dtype=bool)    # create markers for segmentation (array of basins)
+            mask[tuple(np.array(coords, dtype=int).T)] = True
+        with self.stage('watershed'):
+            segmented = segmentation.watershed(               # segmentation
+                transformed,
+                markers=mask,
+                mask=labels                                   # only points where mask==True will be labeled
+            )
+        with self.stage('speckles'):
+            speckles = measure.label(segmented)
+            if self.precision is not None:
+                segmented, speckles = shrink(segmented), shrink(speckles)
+        if self.factors is not None:                          # coarse volumes from threshold_cells_coarse
+            with self.stage('upsample'):
+                segmented, speckles = self.upsample(segmented), self.upsample(speckles)
+        with self.stage('regions'):
+            self.regions = regions(speckles)                  # centroid and area in one pass
+        centroids = self.regions[centroid]
+        area = self.regions[['area']]
 
         return centroids, area, segmented, speckles
 
     def segment_puncta(self, transformed, labels):
         # segmenting puncta.
 
-        coords = pd.DataFrame(measure.regionprops_table(      # get centroids of labels
-                labels,
-                properties=['centroid']
-                ))
-        mask = np.zeros(transformed.shape, dtype=bool)        # create markers for segmentation
-        for i in np.round(np.array(coords, dtype=int)):
-            j, k, l = i
-            mask[j, k, l] = True
-        markers, num_features = ndi.label(mask)
-        segmented = segmentation.watershed(                   # segmentation
-            transformed,
-            markers=markers,
-            mask=labels                                       # only points where mask==True will be labeled
-        )
-        speckles = measure.label(segmented)
-        centroids = pd.DataFrame(measure.regionprops_table(   # get centroids of labels
-                speckles,
-
-                properties=['centroid']
-                ))
-        area = pd.DataFrame(measure.regionprops_table(        # get area of labels
-                speckles,
-                properties=['area']
-                ))
+        if self.block is not None:
+            return self.segment_tiled(transformed, labels, cells=False)
+
+        with self.stage('markers'):
+            coords = regions(labels)[centroid]                # get centroids of labels
+            mask = np.zeros(transformed.shape, dtype=bool)    # create markers for segmentation
+            mask[tuple(np.array(coords, dtype=int).T)] = True
+            markers, num_features = ndi.label(mask)
+        with self.stage('watershed'):
+            segmented = segmentation.watershed(               # segmentation
+                transformed,
+                markers=markers,
+                mask=labels                                   # only points where mask==True will be labeled
+            )
+        with self.stage('speckles'):
+            speckles = measure.label(segmented)
+            if self.precision is not None:
+                segmented, speckles = shrink(segmented), shrink(speckles)
+        with self.stage('regions'):
+            self.regions = regions(speckles)                  # centroid, area and bounding box in one pass
+        centroids = self.regions[centroid]
+        area = self.regions[['area']]
 
         return centroids, area, segmented, speckles
 
-def segment(file,
+centroid = ['centroid-0', 'centroid-1', 'centroid-2']
+
+feature = np.dtype([('label', np.int64),            # label in the segmentation (table row + 1)
+                    ('centroid', float, 3),         # voxels (z, y, x)
+                    ('position', float, 3),         # µm
+                    ('voxels', float),              # NaN for unmeasured regions
+                    ('volume', float)])             # µm^3
+
+def features(centroids, area, spacing = None):
+    # structured per-region table from segment()'s centroid and area tables (rows = label - 1).
+
+    table = np.zeros(len(area), dtype=feature)
+    table['label'] = np.asarray(area.index) + 1
+    table['centroid'] = np.asarray(centroids, dtype=float).reshape(-1, 3)
+    scale = np.ones(3) if spacing is None else np.asarray(spacing, dtype=float)
+    table['position'] = table['centroid'] * scale
+    voxels = np.asarray(area).reshape(-1)
+    table['voxels'] = voxels if voxels.dtype.kind in 'biuf' else pd.to_numeric(voxels, errors='coerce')
+    table['volume'] = table['voxels'] * np.prod(scale)
+    return table
+
+def coarse_factors(spacing):
+    # per-axis downsampling factors making voxels roughly isotropic (e.g. 0.5/0.0625/0.0625 µm -> 1, 8, 8).
+
+    spacing = np.asarray(spacing, dtype=float)
+    return np.maximum(np.round(spacing.max() / spacing), 1).astype(int)
+
+def downsample(image, factors, dtype = float):
+    # means over blocks of factors voxels (partial blocks at the far edges average what they hold).
+
+    for axis in np.argsort(factors)[::-1]:                  # shrink the most reduced axes first
+        if factors[axis] == 1:
+            continue
+        starts = np.arange(0, image.shape[axis], factors[axis])
+        counts = np.diff(np.append(starts, image.shape[axis]))
+        shape = [1] * image.ndim
+        shape[axis] = len(counts)
+        image = np.add.reduceat(image, starts, axis=axis, dtype=float) / counts.reshape(shape)
+    return image.astype(dtype, copy=False)
+
+def upsample(volume, factors, shape):
+    # nearest-neighbour enlargement of volume by factors, cropped to shape.
+
+    return volume[np.ix_(*[np.arange(n) // f for n, f in zip(shape, factors)])]
+
+def shrink(labels):
+    # labels in the smallest unsigned type holding their largest value (uint16 or uint32).
+
+    n = int(labels.max()) if labels.size else 0
+    return labels.astype(np.uint16 if n < 2**16 else np.uint32, copy=False)
+
+def sobel(image, out, scale = 1.0, threads = 1):
+    # separable Sobel edge magnitude, as skimage.filters.sobel: sqrt(mean over axes of the
+    # squared edge response), computed in out's dtype with two scratch volumes and
+    # 1D passes instead of a full 3x3x3 convolution and a float64 copy per axis.
+
+    edge = np.array([1.0, 0.0, -1.0])
+    smooth = np.array([1.0, 2.0, 1.0]) / 4
+    a, b = np.empty_like(out), np.empty_like(out)
+
+    out[...] = 0
+    for axis in range(image.ndim):
+        tiling.lines(lambda src, axis, dst: ndi.correlate1d(src, edge, axis, output=dst, mode='reflect'),
+                     image, a, axis, threads)
+        for other in range(image.ndim):
+            if other != axis:
+                tiling.lines(lambda src, axis, dst: ndi.correlate1d(src, smooth, axis, output=dst, mode='reflect'),
+                             a, b, other, threads)
+                a, b = b, a
+        np.multiply(a, a, out=a)
+        out += a
+
+    np.sqrt(out, out=out)
+    out *= scale / np.sqrt(image.ndim)
+    return out
+
+def table(area, centroids):
+    # regionprops_table-style DataFrame (label, centroid-i, area) of labels 1..n.
+
+    ndim = centroids.shape[1]
+    columns = {'label': np.arange(1, len(area) + 1)}
+    columns.update({f'centroid-{i}': centroids[:, i] for i in range(ndim)})
+    columns['area'] = area.astype(float)
+    present = area > 0                                        # regionprops skips absent labels
+
+    return pd.DataFrame(columns)[present].reset_index(drop=True)
+
+def regions(labels):
+    # centroid and area of every label: one bincount per coordinate over the foreground
+    # voxels, instead of a regionprops walk per property.
+
+    n = int(labels.max()) if labels.size else 0
+    found = np.nonzero(labels)
+    values = labels[found]
+    area = np.bincount(values, minlength=n + 1)[1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroids = np.stack([np.bincount(values, weights=coords, minlength=n + 1)[1:] / area
+                              for coords in found], axis=1)
+
+    return table(area, centroids)
+
+def segment(file,                                # filename or loading.stack shared across channels
          channel,
          spacing,                                 # size of image in microns (z-stack interval, x, y)
          sigma = 3,                               # standard deviation for Gaussian kernel
          width = 10,                              # threshold for morphological operations
-         pixels = [1, 1, 1]):                     # pixel resolution of image (z, x, y)
+         pixels = [1, 1, 1],                      # pixel resolution of image (z, x, y)
+         block = None,                            # block size (z, y, x) for out-of-core segmentation
+         profile = None,                          # profiling.profiler recording each step
+         cache = None,                            # caching.cache reusing results across runs (volumes it doesn't keep are None)
+         precision = None,                        # e.g. 'float32': compact filters and labels (default float64)
+         threads = None,                          # threads per filter (same result as one)
+         approximate = None,                      # sigma from which the Gaussian is approximated by box filters
+         downsample = None,                       # cells only: 'auto' or (z, y, x) factors of a coarser grid
+         li_factor = None):                       # edge threshold as a multiple of Li's (default 1)
+
+    if cache is not None:
+        name = file.file if isinstance(file, stack) else file
+        # None (Gaussian rounded to the stack's type) and 'float64' are different pipelines. the tiled
+        # path keeps its scratch volumes and labels in the given precision, but ignores downsample.
+        tiled = block is not None
+        key = cache.key(name, channel=channel, spacing=spacing, sigma=sigma, width=width, pixels=pixels,
+                        precision=None if precision is None else str(np.dtype(precision)),
+                        approximate=approximate, tiled=tiled,
+                        downsample=downsample if channel == 0 and not tiled else None, li_factor=li_factor)
+        result = cache.load(key)
+        if result is not None:
+            print(f'channel {channel}: cached')
+            return result
+        result = segment(file, channel, spacing, sigma, width, pixels, block, profile,
+                         precision = precision, threads = threads, approximate = approximate,
+                         downsample = downsample, li_factor = li_factor)
+        cache.save(key, result)
+        return result
 
     image = img(file,
                 channel,
                 sigma,
                 width,
                 spacing,
-                pixels)
+                pixels,
+                block,
+                profile,
+                precision,
+                threads,
+                approximate,
+                downsample if channel == 0 else None,
+                li_factor)
 
     print(image)
 
@@ -178,6 +565,8 @@ def segment(file,
 
     if channel == 0:
         centroids, area, segmented, speckles = image.segment_cells(transformed, labels)
+        if image.factors is not None:
+            transformed, labels = image.upsample(transformed), image.upsample(labels)
     else:
         centroids, area, segmented, speckles = image.segment_puncta(transformed, labels)
 
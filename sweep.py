@@ -0,0 +1,164 @@
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import pandas as pd
+from loading import stack
+from segmentation import img
+import pipeline
+
+class graph:
+    # memoized task graph. a node runs once, on a thread pool, as soon as its inputs are ready;
+    # its value is dropped once every node reading it has run (unless it was asked for).
+    # ready nodes run deepest first, so settings are finished before new intermediates are made.
+
+    def __init__(self):
+        self.nodes = {}                                 # key: (func, input keys)
+
+    def add(self, key, func, *inputs):
+        # node key computing func(*values of inputs); adding an existing key reuses it.
+
+        if key not in self.nodes:
+            self.nodes[key] = (func, inputs)
+        return key
+
+    def depth(self, key):
+        inputs = self.nodes[key][1]
+        return 1 + max((self.depth(i) for i in inputs), default=0)
+
+    def run(self, keys, threads = 1):
+        # values of keys: {key: value}.
+
+        readers = {key: 0 for key in self.nodes}
+        for func, inputs in self.nodes.values():
+            for i in inputs:
+                readers[i] += 1
+        waiting = {key: len(inputs) for key, (func, inputs) in self.nodes.items()}
+        depth = {key: self.depth(key) for key in self.nodes}
+        order = {key: i for i, key in enumerate(self.nodes)}
+        ready = [key for key, n in waiting.items() if n == 0]
+        values, running = {}, {}
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            while ready or running:
+                ready.sort(key=lambda key: (depth[key], -order[key]))
+                while ready and len(running) < threads:
+                    key = ready.pop()
+                    func, inputs = self.nodes[key]
+                    running[pool.submit(func, *[values[i] for i in inputs])] = key
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for job in done:
+                    key = running.pop(job)
+                    values[key] = job.result()
+                    for other, (func, inputs) in self.nodes.items():
+                        if key in inputs:
+                            waiting[other] -= 1
+                            if waiting[other] == 0:
+                                ready.append(other)
+                    for i in self.nodes[key][1]:
+                        readers[i] -= 1
+                        if readers[i] == 0 and i not in keys:
+                            del values[i]       # every reader has run
+
+        return {key: values[key] for key in keys}
+
+def settings(sigmas, widths, li_factors = (1,)):
+    # the (sigma, width, li_factor) grid.
+
+    return [(s, w, f) for s in sigmas for f in li_factors for w in widths]
+
+def sweep(file,                                 # filename or loading.stack
+          channel,
+          spacing,                              # size of image in microns (z-stack interval, x, y)
+          sigmas,                               # Gaussian sigmas to try
+          widths,                               # morphological widths to try
+          li_factors = (1,),                    # edge thresholds to try, as multiples of Li's
+          pixels = [1, 1, 1],
+          threads = None,                       # settings run concurrently (default: CPU count, capped by memory)
+          precision = None,                     # as segment()
+          filter_threads = None,
+          approximate = None):
+    # segment one channel for every (sigma, width, li_factor) setting, as segment() would, but
+    # computing each shared intermediate once: the edge map (Gaussian, median, Sobel) and Li's
+    # threshold per sigma, the (filled) mask per sigma and li_factor; only the morphology,
+    # labeling, distance transform and watershed run per setting.
+    # returns one row per setting: the edge cutoff, object count and sizes (voxels and µm^3), and the
+    # seconds spent on that setting alone.
+
+    image = stack(file) if isinstance(file, str) else file
+    threads = threads or os.cpu_count() or 1
+    memory = pipeline.available_memory()
+    if memory:                                  # one edge map per sigma, plus ~6 volumes per running node
+        volume = np.prod(image.shape[:3]) * np.dtype(precision or float).itemsize
+        threads = max(1, min(threads, int((memory // volume - len(sigmas)) // 6)))
+
+    def channel_img(sigma, width = None, li_factor = None):
+        return img(image, channel, sigma, width, spacing, pixels, precision = precision,
+                   threads = filter_threads, approximate = approximate, li_factor = li_factor)
+
+    def measure(sigma, width, li_factor, cutoff, mask):
+        start = time.perf_counter()
+        segmenter = channel_img(sigma, width, li_factor)
+        transformed, labels = segmenter.objects(segmenter.clean(mask))
+        if channel == 0:
+            centroids, area, segmented, speckles = segmenter.segment_cells(transformed, labels)
+        else:
+            centroids, area, segmented, speckles = segmenter.segment_puncta(transformed, labels)
+        voxels = np.asarray(area['area'], dtype=float)
+        volume = voxels * np.prod(segmenter.original_spacing)
+        return {'channel': channel, 'sigma': sigma, 'width': width, 'li_factor': li_factor, 'cutoff': cutoff,
+                'objects': len(voxels),
+                'voxels_mean': voxels.mean() if len(voxels) else np.nan,
+                'voxels_median': np.median(voxels) if len(voxels) else np.nan,
+                'voxels_min': voxels.min() if len(voxels) else np.nan,
+                'voxels_max': voxels.max() if len(voxels) else np.nan,
+                'volume_mean': volume.mean() if len(volume) else np.nan,
+                'seconds': time.perf_counter() - start}
+
+    dag = graph()
+    leaves = []
+    for sigma, width, li_factor in settings(sigmas, widths, li_factors):
+        edges = dag.add(('edges', sigma), lambda sigma=sigma: channel_img(sigma).edges())
+        li = dag.add(('li', sigma), lambda edges, sigma=sigma: channel_img(sigma).cutoff(edges), edges)
+        cutoff = dag.add(('cutoff', sigma, li_factor), lambda li, li_factor=li_factor: li_factor * li, li)
+        mask = dag.add(('mask', sigma, li_factor),
+                       lambda edges, cutoff, sigma=sigma: channel_img(sigma).mask(edges, cutoff), edges, cutoff)
+        leaves.append(dag.add(('measure', sigma, width, li_factor),
+                              lambda cutoff, mask, s=sigma, w=width, f=li_factor: measure(s, w, f, cutoff, mask),
+                              cutoff, mask))
+
+    results = dag.run(leaves, threads)
+    return pd.DataFrame([results[i] for i in leaves])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='segment one channel over a grid of sigma/width/li-factor settings, '
+                                                 'sharing intermediates, and report object counts and sizes.')
+    parser.add_argument('filename', help='.tif stack (z, y, x, channel)')
+    parser.add_argument('-c', '--channel', type=int, default=1, help='0: cells, 1: puncta1, 2: puncta2')
+    parser.add_argument('--sigma', type=float, nargs='+', default=None,
+                        help="Gaussian sigmas (default: the channel's in pipeline.py)")
+    parser.add_argument('--width', type=float, nargs='+', default=None,
+                        help="morphological widths (default: the channel's in pipeline.py)")
+    parser.add_argument('--li-factor', type=float, nargs='+', default=[1],
+                        help="edge thresholds as multiples of Li's (default 1)")
+    parser.add_argument('--spacing', type=float, nargs=3, default=pipeline.spacing, metavar=('Z', 'Y', 'X'),
+                        help='microscope spacing in µm')
+    parser.add_argument('-j', '--threads', type=int, default=None, help='settings run concurrently')
+    parser.add_argument('--precision', default=None, choices=['float32', 'float64'])
+    parser.add_argument('--filter-threads', type=int, default=None, help='threads per filter')
+    parser.add_argument('--approximate', type=float, default=None, metavar='SIGMA',
+                        help='approximate Gaussian filters of at least this sigma by repeated box filters')
+    parser.add_argument('-o', '--output', default=None, help='write results to this CSV')
+    args = parser.parse_args()
+
+    defaults = pipeline.channels[args.channel]
+    start = time.time()
+    results = sweep(args.filename, args.channel, args.spacing,
+                    args.sigma or [defaults['sigma']], args.width or [defaults['width']], args.li_factor,
+                    threads = args.threads, precision = args.precision, filter_threads = args.filter_threads,
+                    approximate = args.approximate)
+    print(results.to_string(index=False))
+    print(f'{len(results)} settings...done ' + str(time.time() - start))
+    if args.output:
+        results.to_csv(args.output, index=False)
@@ -0,0 +1,365 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy import ndimage as ndi
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from skimage import measure
+
+# out-of-core helpers: every function walks the volume in blocks, so peak memory
+# is set by the block size (plus halo) instead of the stack size.
+
+def scratch(shape, dtype, directory = None):
+    # disk-backed array for intermediates that don't fit in memory.
+    # the file is unlinked straight away; the mapping stays valid until the array is freed.
+
+    handle, path = tempfile.mkstemp(suffix='.npy', dir=directory)
+    os.close(handle)
+    array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+    try:
+        os.unlink(path)
+    except OSError:                                     # open files can't be unlinked on Windows
+        pass
+    return array
+
+def per_axis(value, ndim):
+    return tuple(value) if np.ndim(value) else (value,) * ndim
+
+def blocks(shape, size, halo = 0, low = None):
+    # yield (outer, inner, local) slices: inner tiles the volume, outer adds the halo
+    # (clipped at the volume edge), local is inner relative to outer.
+    # low overrides the halo on the low side of each axis only.
+
+    size = per_axis(size, len(shape))
+    halo = per_axis(halo, len(shape))
+    low = halo if low is None else per_axis(low, len(shape))
+
+    starts = [range(0, n, s) for n, s in zip(shape, size)]
+    for corner in np.ndindex(*[len(i) for i in starts]):
+        outer, inner, local = [], [], []
+        for axis, i in enumerate(corner):
+            start = starts[axis][i]
+            stop = min(start + size[axis], shape[axis])
+            lo = max(start - low[axis], 0)
+            hi = min(stop + halo[axis], shape[axis])
+            outer.append(slice(lo, hi))
+            inner.append(slice(start, stop))
+            local.append(slice(start - lo, stop - lo))
+        yield tuple(outer), tuple(inner), tuple(local)
+
+def apply(func, src, out, size, halo = 0):
+    # out = func(src), one block at a time. halo must cover func's footprint.
+
+    for outer, inner, local in blocks(src.shape, size, halo):
+        out[inner] = func(np.asarray(src[outer]))[local]
+    return out
+
+def longest(shape, exclude = None):
+    # longest axis of shape, other than exclude.
+
+    return max((axis for axis in range(len(shape)) if axis != exclude), key=lambda axis: shape[axis])
+
+def slabs(shape, count, axis, halo = 0):
+    # blocks() of count slabs along one axis, overlapping by halo along it.
+
+    size = list(shape)
+    size[axis] = max(-(-shape[axis] // count), 1)
+    margin = [0] * len(shape)
+    margin[axis] = halo
+    return blocks(shape, size, margin)
+
+def concurrently(run, jobs, threads):
+    # run(job) for every job on a pool of threads (in this thread when threads is 1).
+
+    jobs = list(jobs)
+    if threads <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            run(job)
+        return
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for _ in pool.map(run, jobs):               # re-raises the first error
+            pass
+
+def parallel(func, src, out, threads, halo = 0):
+    # out = func(src) on threads overlapping slabs of the longest axis, concurrently.
+    # halo must cover func's footprint; scipy/skimage filters release the GIL.
+
+    def run(block):
+        outer, inner, local = block
+        out[inner] = func(np.asarray(src[outer]))[local]
+
+    concurrently(run, slabs(src.shape, threads, longest(src.shape), halo), threads)
+    return out
+
+def lines(func, src, out, axis, threads):
+    # func(src, axis, out) for a 1D filter along axis, concurrently on slabs cut along another
+    # axis: every line along axis stays whole, so no halo is needed and the result is exact.
+    # src may be out (1D filters work line by line).
+
+    def run(block):
+        _, inner, _ = block
+        func(src[inner], axis, out[inner])
+
+    concurrently(run, slabs(src.shape, threads, longest(src.shape, exclude=axis)), threads)
+    return out
+
+def gaussian(src, sigma, out, threads = 1, truncate = 4.0):
+    # ndi.gaussian_filter(src, sigma, output=out) (mode 'reflect'), one axis at a time
+    # with each pass split across threads. identical to the serial filter.
+
+    sigma = per_axis(sigma, src.ndim)
+    axes = [axis for axis in range(src.ndim) if sigma[axis] > 1e-15]
+    if not axes:
+        out[...] = src
+        return out
+
+    for axis in axes:
+        lines(lambda a, axis, b: ndi.gaussian_filter1d(a, sigma[axis], axis, output=b, truncate=truncate),
+              src, out, axis, threads)
+        src = out
+    return out
+
+def box_widths(sigma, passes = 3):
+    # odd box widths whose repeated (passes-fold) convolution has a standard deviation close
+    # to sigma (a box of width w has variance (w**2 - 1) / 12).
+
+    ideal = np.sqrt(12 * sigma**2 / passes + 1)
+    lower = int(np.floor(ideal))
+    lower -= 1 - lower % 2
+    upper = lower + 2
+    m = int(round((12 * sigma**2 - passes * lower**2 - 4 * passes * lower - 3 * passes) / (-4 * lower - 4)))
+    return [lower] * m + [upper] * (passes - m)
+
+def box_gaussian(src, sigma, out, threads = 1, passes = 3):
+    # Gaussian filter approximated by passes moving averages per axis (mode 'reflect').
+    # each pass costs the same whatever the width, so it pays off for large sigma,
+    # where the exact kernel spans 8 * sigma + 1 voxels per axis.
+
+    sigma = per_axis(sigma, src.ndim)
+    first = True
+    for axis in range(src.ndim):
+        if sigma[axis] <= 1e-15:
+            continue
+        for width in box_widths(sigma[axis], passes):
+            lines(lambda a, axis, b: ndi.uniform_filter1d(a, width, axis, output=b),
+                  src, out, axis, threads)
+            src, first = out, False
+    if first:
+        out[...] = src
+    return out
+
+def extremes(src, size, func = None):
+    # (min, max) of func(src).
+
+    lo, hi = np.inf, -np.inf
+    for _, inner, _ in blocks(src.shape, size):
+        block = np.asarray(src[inner]) if func is None else func(np.asarray(src[inner]))
+        lo, hi = min(lo, block.min()), max(hi, block.max())
+    return lo, hi
+
+def threshold_li(src, size, max_iter = 1000):
+    # Li's minimum cross-entropy threshold (as skimage.filters.threshold_li for float
+    # images), accumulating the foreground/background means block by block.
+    # iterates to the fixed point rather than to skimage's min-gap tolerance.
+
+    image_min, image_max = extremes(src, size)
+    if image_min == image_max:
+        return image_min
+
+    def means(t):
+        # means of (src - image_min) above and at/below t, or mean of everything if t is None.
+        sums = np.zeros(2)
+        counts = np.zeros(2)
+        for _, inner, _ in blocks(src.shape, size):
+            block = np.asarray(src[inner], dtype=float) - image_min
+            if t is None:
+                sums[0] += block.sum()
+                counts[0] += block.size
+                continue
+            fore = block > t
+            sums += block[fore].sum(), block[~fore].sum()
+            counts += np.count_nonzero(fore), fore.size - np.count_nonzero(fore)
+        return sums / np.maximum(counts, 1)
+
+    t_next = means(None)[0]
+    tolerance = np.finfo(float).eps * (image_max - image_min)
+    for _ in range(max_iter):
+        t_curr = t_next
+        mean_fore, mean_back = means(t_curr)
+
+        if mean_back == 0.0:
+            break
+
+        t_next = (mean_back - mean_fore) / (np.log(mean_back) - np.log(mean_fore))
+
+        if abs(t_next - t_curr) <= tolerance:
+            break
+
+    return t_next + image_min
+
+def label(src, out, size, connectivity = 1, func = None):
+    # connected components of func(src) across block boundaries (as skimage.measure.label:
+    # regions of equal non-zero value, numbered in raster order). returns the count.
+    # blocks overlap by one voxel on their low side, so every neighbouring pair of voxels
+    # is seen by one block; labels meeting in the overlap are merged with a union-find.
+
+    shape = src.shape
+    offset = 0
+    pairs = []
+    firsts = [np.array([np.iinfo(np.int64).max])]                 # provisional label 0 = background
+
+    for outer, inner, local in blocks(shape, size, halo=0, low=1):
+        block = np.asarray(src[outer]) if func is None else func(np.asarray(src[outer]))
+        labels, n = measure.label(block, connectivity=connectivity, background=0, return_num=True)
+        labels = np.where(labels > 0, labels + offset, 0)
+
+        # merge with the labels already written for the overlapping low-side voxels.
+        seen = np.ones(labels.shape, dtype=bool)
+        seen[local] = False
+        linked = seen & (labels > 0)
+        if linked.any():
+            pairs.append(np.stack([labels[linked], np.asarray(out[outer])[linked]]))
+
+        # first (raster-order) voxel of each provisional label, for the final numbering.
+        first = np.full(n, np.iinfo(np.int64).max)
+        inner_labels = labels[local]
+        found = np.nonzero(inner_labels)
+        if len(found[0]):
+            flat = np.ravel_multi_index(tuple(c + s.start for c, s in zip(found, inner)), shape)
+            np.minimum.at(first, inner_labels[found] - offset - 1, flat)
+        firsts.append(first)
+
+        out[inner] = inner_labels
+        offset += n
+
+    # union-find over provisional labels, then renumber components in raster order.
+    pairs = np.concatenate(pairs, axis=1) if pairs else np.zeros((2, 0), dtype=np.int64)
+    graph = coo_matrix((np.ones(pairs.shape[1]), (pairs[0], pairs[1])), shape=(offset + 1, offset + 1))
+    _, component = connected_components(graph, directed=False)
+
+    firsts = np.concatenate(firsts)
+    component_first = np.full(component.max() + 1, np.iinfo(np.int64).max)
+    np.minimum.at(component_first, component, firsts)
+
+    present = component_first < np.iinfo(np.int64).max
+    rank = np.zeros(len(component_first), dtype=out.dtype)
+    order = np.argsort(component_first[present], kind='stable')
+    rank[np.flatnonzero(present)[order]] = np.arange(1, present.sum() + 1)
+
+    mapping = rank[component]
+    mapping[0] = 0
+    remap(out, out, mapping, size)
+
+    return int(present.sum())
+
+def remap(src, out, mapping, size):
+    # out = mapping[src], block by block.
+
+    for _, inner, _ in blocks(src.shape, size):
+        out[inner] = mapping[np.asarray(src[inner])]
+    return out
+
+def sizes(labels, n, size):
+    # voxel count of labels 0..n.
+
+    counts = np.zeros(n + 1, dtype=np.int64)
+    for _, inner, _ in blocks(labels.shape, size):
+        counts += np.bincount(np.asarray(labels[inner]).ravel(), minlength=n + 1)
+    return counts
+
+def centroids(labels, n, size):
+    # (voxel count, centroid) of labels 1..n, from per-block coordinate sums.
+
+    counts = np.zeros(n + 1, dtype=np.int64)
+    sums = np.zeros((labels.ndim, n + 1))
+    for _, inner, _ in blocks(labels.shape, size):
+        block = np.asarray(labels[inner])
+        found = np.nonzero(block)
+        values = block[found]
+        counts += np.bincount(values, minlength=n + 1)
+        for axis, coords in enumerate(found):
+            sums[axis] += np.bincount(values, weights=coords + inner[axis].start, minlength=n + 1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return counts[1:], (sums[:, 1:] / counts[1:]).T
+
+def find_objects(labels, n, size):
+    # bounding box (tuple of slices) of labels 1..n, merged across blocks.
+
+    lo = np.full((n, labels.ndim), np.iinfo(np.int64).max)
+    hi = np.full((n, labels.ndim), -1)
+    for _, inner, _ in blocks(labels.shape, size):
+        for i, box in enumerate(ndi.find_objects(np.asarray(labels[inner]), max_label=n)):
+            if box is None:
+                continue
+            start = [s.start + o.start for s, o in zip(box, inner)]
+            stop = [s.stop + o.start for s, o in zip(box, inner)]
+            lo[i] = np.minimum(lo[i], start)
+            hi[i] = np.maximum(hi[i], stop)
+
+    return [tuple(slice(a, b) for a, b in zip(l, h)) if h[0] >= 0 else None for l, h in zip(lo, hi)]
+
+def erosion(mask, radius, sampling = None):
+    # skimage.morphology.isotropic_erosion for one block (radius in units of sampling).
+    # a block without background is left untouched (the distance transform is undefined without zeros).
+
+    if mask.all():
+        return mask.copy()
+    return ndi.distance_transform_edt(mask, sampling=sampling) > radius
+
+def dilation(mask, radius, sampling = None):
+    # skimage.morphology.isotropic_dilation for one block.
+
+    if not mask.any():
+        return mask.copy()
+    return ndi.distance_transform_edt(~mask, sampling=sampling) <= radius
+
+def label_points(points):
+    # ndi.label numbering for a sparse, raster-sorted set of voxels: face-adjacent
+    # voxels share a label, labels follow the first voxel of each group.
+
+    if not len(points):
+        return np.zeros(0, dtype=np.int32)
+    pairs = cKDTree(points).query_pairs(1, p=1, output_type='ndarray')
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(points),) * 2)
+    _, component = connected_components(graph, directed=False)
+
+    first = np.full(len(points), len(points))
+    np.minimum.at(first, component, np.arange(len(points)))
+    return (np.argsort(np.argsort(first))[component] + 1).astype(np.int32)
+
+def pad(box, margin, shape):
+    # grow a bounding box by margin voxels per axis, clipped to shape.
+
+    return tuple(slice(max(s.start - m, 0), min(s.stop + m, n)) for s, m, n in zip(box, margin, shape))
+
+def distance_transform(labels, out, boxes, sampling):
+    # ndi.distance_transform_edt(labels, sampling) object by object.
+    # each object's box is grown until it holds every voxel closer than the object's
+    # largest distance, so the result is exact; background stays 0.
+
+    sampling = np.asarray(sampling, dtype=float)
+    for i, box in enumerate(boxes):
+        if box is None:
+            continue
+        # no voxel lies further from the background than half the box's thinnest side,
+        # so starting there usually makes the first crop the last.
+        reach = min((s.stop - s.start) * d for s, d in zip(box, sampling)) / 2
+        margin = np.ceil(reach / sampling).astype(int) + 1
+        outer = pad(box, margin, labels.shape)
+        while True:
+            crop = np.asarray(labels[outer])
+            distance = ndi.distance_transform_edt(crop, sampling=sampling)
+            obj = crop == i + 1
+            margin = np.maximum(margin, np.ceil(distance[obj].max() / sampling).astype(int))
+            grown = pad(box, margin, labels.shape)
+            if grown == outer:                                  # nothing closer lies outside the crop
+                break
+            outer = grown
+
+        view = np.asarray(out[outer])
+        view = np.where(obj, distance, view)
+        out[outer] = view
+    return out
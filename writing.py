@@ -1,17 +1,98 @@
 import csv
+import numpy as np
 import pandas as pd
 
-def write_to_csv(filename, count, volume, coloc):
-    # write CSV file.
+def arrow():
+    # pyarrow and pyarrow.parquet (optional, for Parquet output), imported on first use
+    # since they take longer to load than the rest of the pipeline's writers.
 
-    _, average_count = count        # average puncta count per cell
-    _, average_volume = volume      # average puncta volume per cell (µm^3)
-    average_coloc = coloc           # average colocalization per cell (overlapped count / total puncta count)
-    average_count = [i for i in average_count if i != 0]
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('parquet output requires pyarrow (pip install pyarrow)') from None
+    return pyarrow, pyarrow.parquet
 
-    values = pd.DataFrame()
-    values['average_count'] = pd.Series(average_count)
-    values['average_volume'] = pd.Series(average_volume)
-    values['average_coloc'] = pd.Series(average_coloc)
+def write_to_csv(filename, quantified, batch = 2**20):
+    # write CSV file: one row per cell (cell = row of the cell table), streamed from cell_records.
+    # average_count: puncta1 count; average_volume: mean puncta1 volume (µm^3);
+    # average_coloc: puncta1 with a puncta2 partner / puncta1 count. NaN for cells without puncta1.
 
-    values.to_csv(str(filename) + ".csv")
+    path = str(filename) + ".csv"
+    for i, rows in enumerate(quantified.cell_records(batch)):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            coloc = rows['partnered'] / rows['count']
+        values = pd.DataFrame({'cell': rows['cell'],
+                               'average_count': rows['count'],
+                               'average_volume': rows['volume'],
+                               'average_coloc': coloc})
+        values.to_csv(path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+    return path
+
+class writer:
+    # streams tables to <base>_<name>.csv (appended batch by batch) and/or
+    # <base>_<name>.parquet (one row group per batch), so memory stays at one batch.
+    # the first batch of a table fixes its columns.
+
+    formats = ('csv', 'parquet')
+
+    def __init__(self, base, formats = ('csv',)):
+        unknown = set(formats) - set(writer.formats)
+        if unknown:
+            raise ValueError(f'unknown formats: {sorted(unknown)} (expected {writer.formats})')
+        if 'parquet' in formats:
+            self.pa, self.pq = arrow()
+        self.base = str(base)
+        self.formats = tuple(formats)
+        self.parquet = {}                       # table name -> open ParquetWriter
+        self.columns = {}                       # table name -> column names
+        self.rows = {}                          # table name -> rows written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def path(self, name, format):
+        return f'{self.base}_{name}.{format}'
+
+    def write(self, name, batch):
+        # append a batch (DataFrame or dict of equal-length columns) to table name.
+
+        batch = pd.DataFrame(batch)
+        first = name not in self.columns
+        if first:
+            self.columns[name] = list(batch.columns)
+            self.rows[name] = 0
+        elif list(batch.columns) != self.columns[name]:
+            raise ValueError(f'{name}: columns {list(batch.columns)} differ from {self.columns[name]}')
+
+        if 'csv' in self.formats:
+            batch.to_csv(self.path(name, 'csv'), mode='w' if first else 'a', header=first, index=False)
+        if 'parquet' in self.formats:
+            table = self.pa.Table.from_pandas(batch, preserve_index=False)
+            if first:
+                self.parquet[name] = self.pq.ParquetWriter(self.path(name, 'parquet'), table.schema)
+            self.parquet[name].write_table(table)
+
+        self.rows[name] += len(batch)
+
+    def close(self):
+        for handle in self.parquet.values():
+            handle.close()
+        self.parquet = {}
+
+    def paths(self):
+        return [self.path(name, format) for name in self.columns for format in self.formats]
+
+def write_records(base, quantified, formats = ('csv',), batch = 2**20):
+    # per-cell and per-punctum tables of a quantify, streamed in batches of rows.
+    # returns the paths written.
+
+    with writer(base, formats) as output:
+        for rows in quantified.cell_records(batch):
+            output.write('cells', rows)
+        for rows in quantified.puncta_records(batch):
+            output.write('puncta', rows)
+    return output.paths()